@@ -3,10 +3,15 @@
 """Virtual machines for the AMN instructions sets"""
 
 from __future__ import annotations
+import os
+import warnings
 from abc import ABCMeta, abstractmethod
+from array import array
 from enum import EnumMeta
-from collections.abc import Iterator, Iterable, Sequence, Mapping
-from typing import Type, TypeVar, Generic
+from functools import lru_cache, partial
+from operator import add, mul, sub, floordiv, mod, eq, ne, lt, gt, le, ge
+from collections.abc import Callable, Iterator, Iterable, Sequence, Mapping
+from typing import Any, Type, TypeVar, Generic
 
 __version__ = "0.6.1"
 __author__  = "Eric Niklas Wolf"
@@ -16,13 +21,131 @@ __all__ = (
     "am1",
     "repl",
     "main",
+    "jit",
+    "Program",
+    "pack_operands",
+    "unpack_operands",
     "AbstractEnumMeta",
     "AbstractInstruction",
-    "AbstractMachine"
+    "AbstractMachine",
+    "StackMachine",
+    "binary_handler"
 )
 
 T = TypeVar("T")
 I = TypeVar("I")
+R = TypeVar("R")
+M = TypeVar("M", bound="AbstractMachine[Any]")
+
+
+def _cache_size(variable: str, default: int) -> int:
+    """read a cache size from an environment variable, ignoring invalid values with a warning"""
+    value = os.environ.get(variable)
+    if value is None:
+        return default
+    try:
+        return int(value)
+    except ValueError:
+        warnings.warn(f"invalid value for {variable}: {value!r}, using {default}", RuntimeWarning)
+        return default
+
+
+# number of compiled programs to keep, 0 disables caching
+PROGRAM_CACHE_SIZE = _cache_size("AMN_PARSE_CACHE", 128)
+
+# number of parsed lines to keep per instruction set, 0 disables caching
+LINE_CACHE_SIZE = _cache_size("AMN_LINE_CACHE", 4096)
+
+# range of the values held by the stacks and memories of the machines
+MIN_VALUE = -0x8000000000000000
+MAX_VALUE = 0x7FFFFFFFFFFFFFFF
+
+
+def pack_operands(*operands: int) -> int:
+    """pack a single payload or two 32 bit integers into one payload"""
+    match operands:
+        case ():
+            return 0
+        case (payload,):
+            return payload
+        case (first, second) if (
+            -0x80000000 <= first < 0x80000000 and -0x80000000 <= second < 0x80000000
+        ):
+            return first << 32 | second & 0xFFFFFFFF
+        case (_, _):
+            raise OverflowError("operands do not fit into 32 bits")
+        case _:
+            raise ValueError("too many operands")
+
+
+def unpack_operands(payload: int) -> tuple[int, int]:
+    """unpack a payload created by pack_operands"""
+    return (payload >> 32, (payload & 0xFFFFFFFF ^ 0x80000000) - 0x80000000)
+
+
+class Program:
+    """program compiled into parallel arrays of opcodes and payloads"""
+
+    __slots__ = ("opcodes", "payloads", "original")
+
+    opcodes: bytes
+
+    payloads: array[int]
+
+    original: Program | None
+
+    def __init__(
+        self,
+        opcodes: bytes,
+        payloads: array[int],
+        original: Program | None = None
+    ) -> None:
+        if len(opcodes) != len(payloads):
+            raise ValueError("opcodes and payloads differ in length")
+        self.opcodes = opcodes
+        self.payloads = payloads
+        self.original = original
+
+    def __len__(self) -> int:
+        return len(self.opcodes)
+
+    def __eq__(self, other: object) -> bool:
+        if isinstance(other, Program):
+            return self.opcodes == other.opcodes and self.payloads == other.payloads
+        return NotImplemented
+
+    def __hash__(self) -> int:
+        return hash((self.opcodes, self.payloads.tobytes()))
+
+    def unoptimized(self) -> Program:
+        """return the program without super instructions"""
+        return self if self.original is None else self.original
+
+    def fuse(self, rules: Iterable[tuple[bytes, int, tuple[int, ...]]]) -> Program:
+        """
+        Replace the first instruction of every sequence of opcodes matching a rule
+        with a super instruction whose payload contains the payloads of the instructions
+        at the given positions (packed with pack_operands).
+        The other instructions of the sequence are kept to allow jumping into it,
+        super instructions have to advance the counter past them.
+        """
+        program = self.unoptimized()
+        opcodes = bytearray(program.opcodes)
+        payloads = array("q", program.payloads)
+        for pattern, opcode, operands in rules:
+            index = program.opcodes.find(pattern)
+            while index != -1:
+                if opcodes[index] == program.opcodes[index]:   # not replaced by a previous rule
+                    try:
+                        payloads[index] = pack_operands(
+                            *(program.payloads[index + operand] for operand in operands)
+                        )
+                    except OverflowError:
+                        pass
+                    else:
+                        opcodes[index] = opcode
+                index = program.opcodes.find(pattern, index + 1)
+        return Program(bytes(opcodes), payloads, program)
 
 
 class AbstractEnumMeta(EnumMeta, ABCMeta):
@@ -38,18 +161,32 @@ class AbstractInstruction(Generic[T], metaclass=ABCMeta):
         """parse an instance with payload from a line"""
         raise NotImplementedError()
 
+    @classmethod
+    def parse_into(cls, line: str, opcodes: bytearray, payloads: array[int]) -> None:
+        """parse an instance with payload from a line and append its encoded form"""
+        opcode, payload = cls.encode(cls.parse(line))
+        payloads.append(payload)
+        opcodes.append(opcode)
+
     @classmethod
     def parse_program(cls, source: str) -> Iterator[T]:
         """parse a program consisting of multiple lines"""
+        return cls._parse_lines(source, cls.parse)
+
+    @classmethod
+    def _parse_lines(cls, source: str, parse: Callable[[str], R]) -> Iterator[R]:
+        """parse a program line by line to report errors with their line number"""
         for number, line in enumerate(source.split("\n"), start=1):
             line = line.rstrip()
             if line.endswith(";"):
                 try:
-                    instruction = cls.parse(line[:-1])
+                    instruction = parse(line[:-1])
                 except KeyError as error:
                     raise ValueError(f"invalid instruction at line {number}") from error
                 except ValueError as error:
                     raise ValueError(f"invalid payload at line {number}") from error
+                except OverflowError as error:
+                    raise ValueError(f"payload out of range at line {number}") from error
                 except Exception as error:
                     raise ValueError(f"error while parsing line {number}") from error
                 else:
@@ -59,6 +196,45 @@ class AbstractInstruction(Generic[T], metaclass=ABCMeta):
             else:
                 continue
 
+    @classmethod
+    @abstractmethod
+    def encode(cls, instruction: T) -> tuple[int, int]:
+        """encode an instance with payload as opcode and payload"""
+        raise NotImplementedError()
+
+    @classmethod
+    def compile(cls, instructions: Iterable[T]) -> Program:
+        """compile instances with payload into a program"""
+        opcodes = bytearray()
+        payloads = array("q")
+        for number, instruction in enumerate(instructions, start=1):
+            opcode, payload = cls.encode(instruction)
+            try:
+                payloads.append(payload)
+            except OverflowError as error:
+                raise ValueError(f"payload of instruction {number} is out of range") from error
+            opcodes.append(opcode)
+        return Program(bytes(opcodes), payloads)
+
+    @classmethod
+    def optimize(cls, program: Program) -> Program:
+        """replace common sequences of instructions with super instructions"""
+        return program
+
+    @classmethod
+    @lru_cache(maxsize=PROGRAM_CACHE_SIZE)
+    def compile_program(cls, source: str, optimize: bool = True) -> Program:
+        """
+        Parse and compile a program consisting of multiple lines.
+        Results are cached and shared between callers, do not modify them!
+        """
+        opcodes = bytearray()
+        payloads = array("q")
+        for _ in cls._parse_lines(source, lambda line: cls.parse_into(line, opcodes, payloads)):
+            pass
+        program = Program(bytes(opcodes), payloads)
+        return cls.optimize(program) if optimize else program
+
 
 class AbstractMachine(Generic[I], metaclass=ABCMeta):
     """Abstract virtual machine for instructions"""
@@ -73,6 +249,15 @@ class AbstractMachine(Generic[I], metaclass=ABCMeta):
         """create an instance in the default state"""
         raise NotImplementedError()
 
+    @classmethod
+    def default_for_program(
+        cls: Type[M],
+        program: Sequence[Any] | Program,
+        input: Iterator[int]
+    ) -> M:
+        """create an instance in the default state suited for executing a program"""
+        return cls.default(input)
+
     def status(self) -> Mapping[str, object]:
         """return an object mapping values to visualisations"""
         return {"Counter: ": self.counter}
@@ -87,13 +272,192 @@ class AbstractMachine(Generic[I], metaclass=ABCMeta):
         """execute an instruction, returning the output if produced"""
         raise NotImplementedError()
 
-    def execute_program(self, program: Sequence[I]) -> Iterator[int | None]:
+    @abstractmethod
+    def execute_opcode(self, opcode: int, payload: int) -> int | None:
+        """execute an encoded instruction, returning the output if produced"""
+        raise NotImplementedError()
+
+    def execute_program(self, program: Sequence[I] | Program) -> Iterator[int | None]:
         """execute a program, yielding after every instruction"""
-        self.counter = 1
-        while 0 < self.counter <= len(program):
-            yield self.execute_instruction(program[self.counter - 1])
+        self.counter = counter = 1
+        if isinstance(program, Program):
+            opcodes = program.opcodes
+            payloads = program.payloads
+            size = len(opcodes)
+            while 0 < counter <= size:
+                yield self.execute_opcode(opcodes[counter - 1], payloads[counter - 1])
+                counter = self.counter
+        else:
+            size = len(program)
+            while 0 < counter <= size:
+                yield self.execute_instruction(program[counter - 1])
+                counter = self.counter
+
+    def run(self, program: Sequence[I] | Program) -> list[int]:
+        """execute a program until it halts, returning the values written"""
+        return [value for value in self.execute_program(program) if value is not None]
 
     @abstractmethod
     def reset(self) -> None:
         """reset the machine to the default state"""
         raise NotImplementedError()
+
+
+def binary_handler(
+    operation: Callable[[int, int], int]
+) -> Callable[[StackMachine[Any], int, int], int]:
+    """create a handler applying a binary operation to the two topmost values of the stack"""
+    def handler(self: StackMachine[Any], _: int, pc: int) -> int:
+        left = self._left_operand()
+        stack = self._stack
+        stack[left] = operation(stack[left], stack[left + 1])
+        self.stack_pointer = left + 1
+        return pc + 1
+    return handler
+
+
+class StackMachine(AbstractMachine[I]):
+    """Abstract machine with an operand stack executing opcodes through a table of handlers"""
+
+    __slots__ = ("_stack", "stack_pointer", "input", "output")
+
+    _stack: array[int]
+
+    stack_pointer: int
+
+    input: Iterator[int]
+
+    # values written by the last instruction
+    output: list[int]
+
+    # instruction set used to compile programs
+    _INSTRUCTION: Type[AbstractInstruction[Any]]
+
+    # indexed by the opcode, take the payload and index of the instruction and return the next index
+    _HANDLERS: tuple[Callable[[Any, int, int], int], ...]
+
+    @property
+    def stack(self) -> list[int]:
+        """values on the stack from bottom to top"""
+        return self._stack[:self.stack_pointer].tolist()
+
+    @stack.setter
+    def stack(self, values: Iterable[int]) -> None:
+        self._stack = array("q", values)
+        self.stack_pointer = len(self._stack)
+
+    def reserve(self, depth: int) -> None:
+        """preallocate the stack to hold depth values"""
+        if depth > len(self._stack):
+            self._stack.frombytes(bytes(self._stack.itemsize * (depth - len(self._stack))))
+
+    def execute_instruction(self, instruction: I) -> int | None:
+        """execute an instruction, returning the output if produced"""
+        try:
+            opcode, payload = self._INSTRUCTION.encode(instruction)
+        except (AttributeError, IndexError, TypeError) as error:
+            raise ValueError(f"invalid instruction: '{instruction}'") from error
+        return self.execute_opcode(opcode, payload)
+
+    def execute_opcode(self, opcode: int, payload: int) -> int | None:
+        """execute an encoded instruction, returning the output if produced"""
+        self.counter = self._HANDLERS[opcode](self, payload, self.counter - 1) + 1
+        if self.output:
+            return self.output.pop()
+        return None
+
+    def execute_program(self, program: Sequence[I] | Program) -> Iterator[int | None]:
+        """execute a program, yielding after every instruction"""
+        if not isinstance(program, Program):
+            try:
+                program = self._INSTRUCTION.compile(program)
+            except (AttributeError, IndexError, TypeError, ValueError):
+                # report invalid instructions when they are reached
+                yield from super().execute_program(program)
+                return
+        handlers = self._HANDLERS
+        opcodes = program.opcodes
+        payloads = program.payloads
+        output = self.output
+        pc = 0
+        self.counter = 1
+        while 0 <= pc < len(opcodes):
+            pc = handlers[opcodes[pc]](self, payloads[pc], pc)
+            self.counter = pc + 1
+            yield output.pop() if output else None
+
+    def thread_program(self, program: Sequence[I] | Program) -> list[Callable[[int], int]]:
+        """
+        Bind the handler of every instruction of a program to this machine and its payload,
+        the resulting callables take the index of the instruction and return the next one.
+        """
+        if not isinstance(program, Program):
+            program = self._INSTRUCTION.compile(program)
+        handlers = self._HANDLERS
+        return [
+            partial(handlers[opcode], self, payload)
+            for opcode, payload in zip(program.opcodes, program.payloads)
+        ]
+
+    def run(self, program: Sequence[I] | Program) -> list[int]:
+        """
+        Execute a program until it halts, returning the values written.
+        If an error is raised the values written so far are left in output.
+        """
+        threaded = self.thread_program(program)
+        pc = 0
+        try:
+            while 0 <= pc < len(threaded):
+                pc = threaded[pc](pc)
+        finally:
+            self.counter = pc + 1
+        values = self.output
+        self.output = []
+        return values
+
+    def _push(self, value: int) -> None:
+        try:
+            self._stack[self.stack_pointer] = value
+        except IndexError:
+            self._stack.append(value)
+        self.stack_pointer += 1
+
+    def _pop(self) -> int:
+        pointer = self.stack_pointer - 1
+        if pointer < 0:
+            raise IndexError("stack underflow")
+        self.stack_pointer = pointer
+        return self._stack[pointer]
+
+    def _left_operand(self) -> int:
+        """return the index of the left operand of a binary operation without popping it"""
+        left = self.stack_pointer - 2
+        if left < 0:
+            raise IndexError("stack underflow")
+        return left
+
+    def _invalid(self, _: int, pc: int) -> int:
+        raise ValueError("invalid opcode")
+
+    def _lit_add(self, literal: int, pc: int) -> int:
+        top = self.stack_pointer - 1
+        if top < 0:
+            raise IndexError("stack underflow")
+        self._stack[top] += literal
+        return pc + 2
+
+    # handlers of the opcodes 0 to 11 which are the same in every instruction set
+    _BINARY_HANDLERS: tuple[Callable[[Any, int, int], int], ...] = (
+        _invalid,
+        binary_handler(add),
+        binary_handler(mul),
+        binary_handler(sub),
+        binary_handler(floordiv),
+        binary_handler(mod),
+        binary_handler(eq),
+        binary_handler(ne),
+        binary_handler(lt),
+        binary_handler(gt),
+        binary_handler(le),
+        binary_handler(ge)
+    )
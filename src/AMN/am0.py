@@ -3,19 +3,49 @@
 """Simple virtual machine for the AM0 instruction set"""
 
 from __future__ import annotations
-from collections.abc import Iterator, Iterable, Mapping
-from enum import Enum, unique
-from . import AbstractEnumMeta, AbstractInstruction, AbstractMachine
+from typing import TypeAlias
+from collections.abc import Callable, Iterator, Iterable, Mapping, Sequence
+from enum import IntEnum, unique
+from types import CodeType
+from array import array
+from operator import index
+from functools import lru_cache
+from . import (
+    PROGRAM_CACHE_SIZE,
+    LINE_CACHE_SIZE,
+    MIN_VALUE,
+    MAX_VALUE,
+    AbstractEnumMeta,
+    AbstractInstruction,
+    StackMachine,
+    Program,
+    unpack_operands
+)
+from .jit import jit
 
 
 __all__ = (
     "Instruction",
-    "Machine"
+    "Machine",
+    "jit_run",
+    "compile_to_python",
+    "memory_addresses",
+    "FUSIONS"
 )
 
+# super instructions created by Instruction.optimize
+LIT_STORE    = 100
+LOAD_LOAD    = 101
+LOAD_LIT     = 102
+STORE_LOAD   = 103
+LIT_ADD      = 104
+ADD_STORE    = 105
+LOAD_LOAD_LE = 106
+LOAD_LIT_ADD = 107
+
 
 @unique
-class Instruction(AbstractInstruction[tuple["Instruction", int]], Enum, metaclass=AbstractEnumMeta):
+class Instruction(AbstractInstruction[tuple["Instruction", int]], IntEnum, metaclass=AbstractEnumMeta):
     """AM0 instruction"""
 
     ADD   = 1
@@ -38,48 +68,140 @@ class Instruction(AbstractInstruction[tuple["Instruction", int]], Enum, metaclas
     READ  = 18
 
     @classmethod
+    @lru_cache(maxsize=LINE_CACHE_SIZE)
     def parse(cls, line: str) -> tuple[Instruction, int]:
-        """parse an instance from a line like '<Name> <payload>' or '<Name>'"""
+        """parse an instance from a line like '<Name> <payload>' or '<Name>' (results are cached)"""
         name, seperator, payload = line.partition(" ")
         if seperator == "":
-            return (cls[name], 0)
+            return (INSTRUCTIONS[name], 0)
         else:
-            return (cls[name], int(payload))
+            return (INSTRUCTIONS[name], int(payload))
+
+    @classmethod
+    def encode(cls, instruction: tuple[Instruction, int]) -> tuple[int, int]:
+        """encode an instance with payload as opcode and payload, resolving jump targets"""
+        opcode = index(instruction[0])
+        if instruction[0].is_jump():
+            return (opcode, instruction[1] - 1)     # index of the target instruction
+        return (opcode, instruction[1])
+
+    @classmethod
+    def optimize(cls, program: Program) -> Program:
+        """replace common sequences of instructions with super instructions"""
+        return program.fuse(FUSIONS)
 
     def is_jump(self) -> bool:
         """check if the instruction is a jump"""
-        return 14 < self.value < 17
+        return self in JUMPS
 
     def has_payload(self) -> bool:
         """check if the instruction uses its payload"""
-        return self.value > 11
+        return self in PAYLOADS
 
 
-class Machine(AbstractMachine[tuple[Instruction, int]]):
-    """machine for executing AM0 instructions"""
+# programs accepted by the machine
+AnyProgram: TypeAlias = Sequence[tuple[Instruction, int]] | Program
+
+# instructions by name, avoids the lookup machinery of the enum
+INSTRUCTIONS = {instruction.name: instruction for instruction in Instruction}
+
+# instructions for which the predicates hold, faster to test than bit masks of the values
+JUMPS = frozenset((Instruction.JMP, Instruction.JMC))
+PAYLOADS = frozenset(instruction for instruction in Instruction if instruction > 11)
+
+# instructions whose payload is a memory address
+ADDRESSES = frozenset((Instruction.LOAD, Instruction.STORE, Instruction.WRITE, Instruction.READ))
+
+
+# rules for Program.fuse
+FUSIONS = (
+    (bytes((Instruction.LOAD, Instruction.LOAD, Instruction.LE)), LOAD_LOAD_LE, (0, 1)),
+    (bytes((Instruction.LOAD, Instruction.LIT, Instruction.ADD)), LOAD_LIT_ADD, (0, 1)),
+    (bytes((Instruction.LIT, Instruction.STORE)), LIT_STORE, (0, 1)),
+    (bytes((Instruction.LOAD, Instruction.LOAD)), LOAD_LOAD, (0, 1)),
+    (bytes((Instruction.LOAD, Instruction.LIT)), LOAD_LIT, (0, 1)),
+    (bytes((Instruction.STORE, Instruction.LOAD)), STORE_LOAD, (0, 1)),
+    (bytes((Instruction.LIT, Instruction.ADD)), LIT_ADD, (0,)),
+    (bytes((Instruction.ADD, Instruction.STORE)), ADD_STORE, (1,))
+)
 
-    __slots__ = ("stack", "memory", "input")
 
-    stack: list[int]
+# change of the stack size caused by an opcode
+STACK_EFFECTS = (0,) + (-1,) * 11 + (1, -1, 1, 0, -1, 0, 0)
 
-    memory: dict[int, int]
 
-    input: Iterator[int]
+def max_stack_depth(opcodes: bytes) -> int:
+    """estimate the maximum stack depth of a program without super instructions"""
+    depth = maximum = 0
+    for opcode in opcodes:
+        depth = max(depth + STACK_EFFECTS[opcode], 0)
+        maximum = max(depth, maximum)
+    return maximum
 
-    def __init__(self, counter: int, stack: list[int], memory: dict[int, int], input: Iterator[int]) -> None:
+
+def memory_addresses(program: Program) -> range | None:
+    """return the addresses used by a program without super instructions, None if one is negative"""
+    addresses = [
+        payload for opcode, payload in zip(program.opcodes, program.payloads)
+        if opcode in ADDRESSES
+    ]
+    if addresses and min(addresses) < 0:
+        return None
+    return range(max(addresses, default=-1) + 1)
+
+
+class Machine(StackMachine[tuple[Instruction, int]]):
+    """machine for executing AM0 instructions"""
+
+    __slots__ = ("memory",)
+
+    memory: dict[int, int] | array[int]
+
+    # biggest address for which a flat memory is allocated
+    MAX_FLAT_ADDRESS = 1 << 16
+
+    def __init__(self, counter: int, stack: Iterable[int], memory: dict[int, int] | array[int], input: Iterator[int]) -> None:
         self.counter = counter
         self.stack = stack
         self.memory = memory
         self.input = input
+        self.output = []
 
     @classmethod
     def default(cls, input: Iterator[int]) -> Machine:
         """create an instance with default values"""
         return cls(1, [], {}, input)
 
+    @classmethod
+    def default_for_program(cls, program: AnyProgram, input: Iterator[int]) -> Machine:
+        """
+        create an instance with default values whose memory is a flat array
+        covering every address used by the program (unset addresses read as 0)
+        """
+        if not isinstance(program, Program):
+            try:
+                program = Instruction.compile(program)
+            except (AttributeError, IndexError, TypeError, ValueError):
+                # execute_program reports invalid instructions when reached
+                return cls.default(input)
+        program = program.unoptimized()
+        addresses = memory_addresses(program)
+        if not addresses or len(addresses) > cls.MAX_FLAT_ADDRESS + 1:
+            machine = cls.default(input)
+        else:
+            machine = cls(1, [], array("q", bytes(8 * len(addresses))), input)
+        machine.reserve(max_stack_depth(program.opcodes))
+        return machine
+
+    def memory_items(self) -> Iterable[tuple[int, int]]:
+        """return the addresses and values stored in the memory"""
+        if isinstance(self.memory, dict):
+            return self.memory.items()
+        return enumerate(self.memory)
+
     def status(self) -> Mapping[str, object]:
         """return an object mapping values to visualisations"""
-        memory = "\n" + "\n".join(f"\t{key} := {value}" for key, value in self.memory.items())
+        memory = "\n" + "\n".join(f"\t{key} := {value}" for key, value in self.memory_items())
         return {
             "Counter": self.counter,
             "Stack": self.stack,
@@ -88,7 +210,7 @@ class Machine(AbstractMachine[tuple[Instruction, int]]):
 
     def state(self, input: Iterable[int], output: Iterable[int]) -> str:
         """create a string representation of the current machine state"""
-        memory = ", ".join(f"{key}/{value}" for key, value in self.memory.items())
+        memory = ", ".join(f"{key}/{value}" for key, value in self.memory_items())
         return (
             f"({self.counter}, "
             f"{' : '.join(map(str, reversed(self.stack))):ε<1}, "
@@ -97,65 +219,313 @@ class Machine(AbstractMachine[tuple[Instruction, int]]):
             f"{' : '.join(map(str, output)):ε<1})"
         )
 
-    def execute_instruction(self, instruction: tuple[Instruction, int]) -> int | None:
-        """execute an instruction, returning the output if produced"""
-        value = None
-        match instruction:
-            case (Instruction.ADD, _):
-                self.stack[-2] = self.stack[-2] + self.stack[-1]
-                self.stack.pop()
-            case (Instruction.MUL, _):
-                self.stack[-2] = self.stack[-2] * self.stack[-1]
-                self.stack.pop()
-            case (Instruction.SUB, _):
-                self.stack[-2] = self.stack[-2] - self.stack[-1]
-                self.stack.pop()
-            case (Instruction.DIV, _):
-                self.stack[-2] = self.stack[-2] // self.stack[-1]
-                self.stack.pop()
-            case (Instruction.MOD, _):
-                self.stack[-2] = self.stack[-2] % self.stack[-1]
-                self.stack.pop()
-            case (Instruction.EQ, _):
-                self.stack[-2] = int(self.stack[-2] == self.stack[-1])
-                self.stack.pop()
-            case (Instruction.NE, _):
-                self.stack[-2] = int(self.stack[-2] != self.stack[-1])
-                self.stack.pop()
-            case (Instruction.LT, _):
-                self.stack[-2] = int(self.stack[-2] < self.stack[-1])
-                self.stack.pop()
-            case (Instruction.GT, _):
-                self.stack[-2] = int(self.stack[-2] > self.stack[-1])
-                self.stack.pop()
-            case (Instruction.LE, _):
-                self.stack[-2] = int(self.stack[-2] <= self.stack[-1])
-                self.stack.pop()
-            case (Instruction.GE, _):
-                self.stack[-2] = int(self.stack[-2] >= self.stack[-1])
-                self.stack.pop()
-            case (Instruction.LOAD, address):
-                self.stack.append(self.memory[address])
-            case (Instruction.STORE, address):
-                self.memory[address] = self.stack.pop()
-            case (Instruction.LIT, literal):
-                self.stack.append(literal)
-            case (Instruction.JMP, counter):
-                self.counter = counter - 1
-            case (Instruction.JMC, counter):
-                if self.stack.pop() == 0:
-                    self.counter = counter - 1
-            case (Instruction.WRITE, address):
-                value = self.memory[address]
-            case (Instruction.READ, address):
-                self.memory[address] = next(self.input)
-            case invalid:
-                raise ValueError(f"invalid instruction: '{invalid}'")
-        self.counter += 1
-        return value
+    def execute_program_jit(self, program: AnyProgram) -> list[int]:
+        """
+        Execute a program like run, using jit_run for every instruction
+        it can execute (only worth it if Numba is installed).
+        Memory which is no flat array is not supported by jit_run.
+        """
+        if not isinstance(program, Program):
+            program = Instruction.compile(program)
+        program = program.unoptimized()    # jit_run does not know super instructions
+        if not isinstance(self.memory, array):
+            return self.run(program)
+        self.reserve(max_stack_depth(program.opcodes))     # avoid leaving jit_run to grow the stack
+        handlers = self._HANDLERS
+        opcodes = program.opcodes
+        payloads = program.payloads
+        output = array("q", bytes(8 * 64))
+        registers = array("q", (1, self.stack_pointer, 0, 0))
+        while True:
+            jit_run(opcodes, payloads, self.memory, self._stack, array("q"), output, registers)
+            self.output.extend(output[:registers[3]])
+            self.counter = registers[0]
+            self.stack_pointer = registers[1]
+            pc = self.counter - 1
+            if not 0 <= pc < len(opcodes):
+                break
+            # input, growing the stack and errors are handled by the interpreter
+            pc = handlers[opcodes[pc]](self, payloads[pc], pc)
+            registers[0] = self.counter = pc + 1
+            registers[1] = self.stack_pointer
+            registers[3] = 0
+        values = self.output
+        self.output = []
+        return values
+
+    def _load(self, address: int, pc: int) -> int:
+        self._push(self.memory[address])
+        return pc + 1
+
+    def _store(self, address: int, pc: int) -> int:
+        top = self.stack_pointer - 1
+        if top < 0:
+            raise IndexError("stack underflow")
+        self.memory[address] = self._stack[top]     # keep the value on the stack if this fails
+        self.stack_pointer = top
+        return pc + 1
+
+    def _lit(self, literal: int, pc: int) -> int:
+        self._push(literal)
+        return pc + 1
+
+    def _jmp(self, target: int, pc: int) -> int:
+        return target
+
+    def _jmc(self, target: int, pc: int) -> int:
+        if self._pop() == 0:
+            return target
+        return pc + 1
+
+    def _write(self, address: int, pc: int) -> int:
+        self.output.append(self.memory[address])
+        return pc + 1
+
+    def _read(self, address: int, pc: int) -> int:
+        self.memory[address] = next(self.input)
+        return pc + 1
+
+    def _lit_store(self, payload: int, pc: int) -> int:
+        literal, address = unpack_operands(payload)
+        self.memory[address] = literal
+        return pc + 2
+
+    def _load_load(self, payload: int, pc: int) -> int:
+        first, second = unpack_operands(payload)
+        self._push(self.memory[first])
+        self._push(self.memory[second])
+        return pc + 2
+
+    def _load_lit(self, payload: int, pc: int) -> int:
+        address, literal = unpack_operands(payload)
+        self._push(self.memory[address])
+        self._push(literal)
+        return pc + 2
+
+    def _store_load(self, payload: int, pc: int) -> int:
+        first, second = unpack_operands(payload)
+        self.memory[first] = self._pop()
+        self._push(self.memory[second])
+        return pc + 2
+
+    def _add_store(self, address: int, pc: int) -> int:
+        left = self._left_operand()
+        stack = self._stack
+        self.memory[address] = stack[left] + stack[left + 1]
+        self.stack_pointer = left
+        return pc + 2
+
+    def _load_load_le(self, payload: int, pc: int) -> int:
+        first, second = unpack_operands(payload)
+        self._push(self.memory[first] <= self.memory[second])
+        return pc + 3
+
+    def _load_lit_add(self, payload: int, pc: int) -> int:
+        address, literal = unpack_operands(payload)
+        self._push(self.memory[address] + literal)
+        return pc + 3
+
+    _INSTRUCTION = Instruction
+
+    # indexed by the opcode, covers every byte to reject unknown opcodes
+    _HANDLERS: tuple[Callable[[Machine, int, int], int], ...] = StackMachine._BINARY_HANDLERS + (
+        _load,
+        _store,
+        _lit,
+        _jmp,
+        _jmc,
+        _write,
+        _read
+    ) + (StackMachine._invalid,) * (LIT_STORE - 19) + (
+        _lit_store,
+        _load_load,
+        _load_lit,
+        _store_load,
+        StackMachine._lit_add,
+        _add_store,
+        _load_load_le,
+        _load_lit_add
+    ) + (StackMachine._invalid,) * (256 - LOAD_LIT_ADD - 1)
 
     def reset(self) -> None:
         """reset the machine to the default state"""
         self.counter = 1
-        self.stack.clear()
-        self.memory.clear()
+        self.stack_pointer = 0
+        self.output.clear()
+        if isinstance(self.memory, dict):
+            self.memory.clear()
+        else:
+            self.memory[:] = array("q", bytes(self.memory.itemsize * len(self.memory)))
+
+
+@jit(cache=True, boundscheck=False)
+def jit_run(
+    opcodes: bytes,
+    payloads: array[int],
+    memory: array[int],
+    stack: array[int],
+    input: array[int],
+    output: array[int],
+    registers: array[int]
+) -> None:
+    """
+    Execute a compiled program without super instructions until it halts or reaches
+    an instruction which can not be executed with the provided buffers (or would fail or overflow).
+    The registers hold the counter, stack pointer, input position and
+    output position and are updated in place.
+    """
+    pc, pointer, read, written = registers[0] - 1, registers[1], registers[2], registers[3]
+    size = len(opcodes)
+    while 0 <= pc < size:
+        opcode = opcodes[pc]
+        payload = payloads[pc]
+        if opcode <= 11:
+            if pointer < 2:
+                break
+            left = stack[pointer - 2]
+            right = stack[pointer - 1]
+            # overflows are left to the interpreter like division by zero
+            if opcode == 1:
+                if (
+                    (right > 0 and left > MAX_VALUE - right)
+                    or (right < 0 and left < MIN_VALUE - right)
+                ):
+                    break
+                left = left + right
+            elif opcode == 2:
+                if abs(float(left) * float(right)) >= 0x4000000000000000:    # close to the limits
+                    break
+                left = left * right
+            elif opcode == 3:
+                if (
+                    (right < 0 and left > MAX_VALUE + right)
+                    or (right > 0 and left < MIN_VALUE + right)
+                ):
+                    break
+                left = left - right
+            elif opcode == 4:
+                if right == 0 or (right == -1 and left == MIN_VALUE):
+                    break
+                left = left // right
+            elif opcode == 5:
+                if right == 0 or (right == -1 and left == MIN_VALUE):
+                    break
+                left = left % right
+            elif opcode == 6:
+                left = int(left == right)
+            elif opcode == 7:
+                left = int(left != right)
+            elif opcode == 8:
+                left = int(left < right)
+            elif opcode == 9:
+                left = int(left > right)
+            elif opcode == 10:
+                left = int(left <= right)
+            elif opcode == 11:
+                left = int(left >= right)
+            else:
+                break
+            stack[pointer - 2] = left
+            pointer -= 1
+        elif opcode == 12:
+            if pointer >= len(stack) or not 0 <= payload < len(memory):
+                break
+            stack[pointer] = memory[payload]
+            pointer += 1
+        elif opcode == 13:
+            if pointer < 1 or not 0 <= payload < len(memory):
+                break
+            pointer -= 1
+            memory[payload] = stack[pointer]
+        elif opcode == 14:
+            if pointer >= len(stack):
+                break
+            stack[pointer] = payload
+            pointer += 1
+        elif opcode == 15:
+            pc = payload
+            continue
+        elif opcode == 16:
+            if pointer < 1:
+                break
+            pointer -= 1
+            if stack[pointer] == 0:
+                pc = payload
+                continue
+        elif opcode == 17:
+            if written >= len(output) or not 0 <= payload < len(memory):
+                break
+            output[written] = memory[payload]
+            written += 1
+        elif opcode == 18:
+            if read >= len(input) or not 0 <= payload < len(memory):
+                break
+            memory[payload] = input[read]
+            read += 1
+        else:
+            break
+        pc += 1
+    registers[0] = pc + 1
+    registers[1] = pointer
+    registers[2] = read
+    registers[3] = written
+
+
+# python statements implementing an instruction, indented relative to the block
+_TEMPLATES: dict[int, str] = {
+    Instruction.ADD: "right = stack.pop()\nstack[-1] = stack[-1] + right",
+    Instruction.MUL: "right = stack.pop()\nstack[-1] = stack[-1] * right",
+    Instruction.SUB: "right = stack.pop()\nstack[-1] = stack[-1] - right",
+    Instruction.DIV: "right = stack.pop()\nstack[-1] = stack[-1] // right",
+    Instruction.MOD: "right = stack.pop()\nstack[-1] = stack[-1] % right",
+    Instruction.EQ: "right = stack.pop()\nstack[-1] = int(stack[-1] == right)",
+    Instruction.NE: "right = stack.pop()\nstack[-1] = int(stack[-1] != right)",
+    Instruction.LT: "right = stack.pop()\nstack[-1] = int(stack[-1] < right)",
+    Instruction.GT: "right = stack.pop()\nstack[-1] = int(stack[-1] > right)",
+    Instruction.LE: "right = stack.pop()\nstack[-1] = int(stack[-1] <= right)",
+    Instruction.GE: "right = stack.pop()\nstack[-1] = int(stack[-1] >= right)",
+    Instruction.LOAD: "stack.append(memory[{0}])",
+    Instruction.STORE: "memory[{0}] = stack.pop()",
+    Instruction.LIT: "stack.append({0})",
+    Instruction.JMP: "counter = {0}\ncontinue",
+    Instruction.JMC: "if stack.pop() == 0:\n    counter = {0}\n    continue",
+    Instruction.WRITE: "output.append(memory[{0}])",
+    Instruction.READ: "memory[{0}] = next(input)"
+}
+
+
+@lru_cache(maxsize=PROGRAM_CACHE_SIZE)
+def compile_to_python(program: Program) -> CodeType:
+    """
+    Translate a compiled program into the code of a python module defining
+    a function 'run(stack, memory, input, output)' which executes it.
+    Instructions between jump targets are executed as straight line code,
+    only jumps go through the counter.
+    Results are cached and shared between callers.
+    """
+    program = program.unoptimized()
+    size = len(program)
+    leaders = {1}
+    for number, (opcode, payload) in enumerate(zip(program.opcodes, program.payloads), start=1):
+        if opcode in (Instruction.JMP, Instruction.JMC):
+            leaders.add(number + 1)
+            if 0 < payload + 1 <= size:
+                leaders.add(payload + 1)
+    lines = ["def run(stack, memory, input, output):", "    counter = 1", "    while True:"]
+    for number, (opcode, payload) in enumerate(zip(program.opcodes, program.payloads), start=1):
+        if number in leaders:
+            if number > 1:
+                lines.append(f"            counter = {number}")
+            lines.append(f"        if counter == {number}:")
+        try:
+            template = _TEMPLATES[opcode]
+        except KeyError:
+            template = "raise ValueError('invalid opcode')"
+        if opcode in (Instruction.JMP, Instruction.JMC):
+            payload += 1
+        lines.extend("            " + line for line in template.format(payload).split("\n"))
+    if size:
+        lines.append(f"            counter = {size + 1}")
+    lines.append(f"        if not 0 < counter <= {size}:")
+    lines.append("            return")
+    return compile("\n".join(lines), "<am0>", "exec")
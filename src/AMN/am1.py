@@ -3,24 +3,49 @@
 """Simple virtual machine for the AM1 instruction set"""
 
 from __future__ import annotations
-from collections.abc import Iterator, Iterable, Sequence, Mapping
-from enum import Enum, unique
-import re
-from itertools import repeat
-from . import AbstractEnumMeta, AbstractInstruction, AbstractMachine
+from typing import TypeAlias
+from collections.abc import Callable, Iterator, Iterable, Sequence, Mapping
+from array import array
+from enum import IntEnum, unique
+from functools import lru_cache
+from types import CodeType
+from . import (
+    PROGRAM_CACHE_SIZE,
+    LINE_CACHE_SIZE,
+    MIN_VALUE,
+    MAX_VALUE,
+    AbstractEnumMeta,
+    AbstractInstruction,
+    StackMachine,
+    Program
+)
+from .jit import jit
 
 
 __all__ = (
     "MemoryContext",
     "Instruction",
-    "Machine"
+    "Machine",
+    "jit_run",
+    "compile_to_python",
+    "FUSIONS"
 )
 
-INSTRUCTION_PATTERN = re.compile(r"([A-Z]{2,6})(\((.*)\)|( .*))?")
+# bit of an opcode which stores the memory context
+CONTEXT_SHIFT = 7
+
+# offset of opcodes with a lokal context
+LOKAL = 1 << CONTEXT_SHIFT
+
+# super instructions created by Instruction.optimize, with a context like instructions
+LOAD_PUSH  = 100
+LOADA_PUSH = 101
+LIT_PUSH   = 102
+LIT_ADD    = 103
 
 
 @unique
-class MemoryContext(Enum):
+class MemoryContext(IntEnum):
     """Context relative to which an index should be loaded"""
 
     GLOBAL = 0
@@ -28,8 +53,7 @@ class MemoryContext(Enum):
 
     def resolve_address(self, address: int, reference_pointer: int) -> int:
         """resolve an relative address to a absolute one"""
-        if self is MemoryContext.LOKAL:
-            address += reference_pointer
+        address += reference_pointer * self     # GLOBAL is 0, LOKAL is 1
         if address <= 0:
             raise ValueError(
                 f"address {address} references outside the runtime stack (reference pointer: {reference_pointer})"
@@ -38,7 +62,7 @@ class MemoryContext(Enum):
 
 
 @unique
-class Instruction(AbstractInstruction[tuple["Instruction", MemoryContext, int]], Enum, metaclass=AbstractEnumMeta):
+class Instruction(AbstractInstruction[tuple["Instruction", MemoryContext, int]], IntEnum, metaclass=AbstractEnumMeta):
     """AM1 instruction"""
 
     ADD    = 1
@@ -70,69 +94,215 @@ class Instruction(AbstractInstruction[tuple["Instruction", MemoryContext, int]],
     RET    = 27
 
     @classmethod
+    @lru_cache(maxsize=LINE_CACHE_SIZE)
     def parse(cls, line: str) -> tuple[Instruction, MemoryContext, int]:
-        """parse an instance from a line like '<Name> <payload>', '<Name>' or '<Name>(context, payload)'"""
-        match = INSTRUCTION_PATTERN.fullmatch(line)
-        if match is None:
-            raise KeyError("invalid instruction")
-        name = match.group(1)
-        args = match.group(3)
-        arg = match.group(4)
-        if args is not None:
-            first, sep, last = args.partition(",")
+        """
+        parse an instance from a line like '<Name> <payload>', '<Name>' or '<Name>(context, payload)'
+        (results are cached)
+        """
+        name, separator, args = line.partition("(")
+        if separator:
+            if not args.endswith(")"):
+                raise KeyError("invalid instruction")
+            instruction = INSTRUCTIONS[name]
+            first, sep, last = args[:-1].partition(",")
             if sep == "":
-                return (cls[name], MemoryContext.LOKAL, int(first))
+                return (instruction, _LOKAL_CONTEXT, int(first))
             else:
-                return (cls[name], MemoryContext[first.upper()], int(last))
-        elif arg is not None:
-            return (cls[name], MemoryContext.LOKAL, int(arg))
+                return (instruction, CONTEXTS[first.upper()], int(last))
+        name, separator, arg = line.partition(" ")
+        if separator:
+            return (INSTRUCTIONS[name], _LOKAL_CONTEXT, int(arg))
         else:
-            return (cls[name], MemoryContext.LOKAL, 0)
+            return (INSTRUCTIONS[name], _LOKAL_CONTEXT, 0)
+
+    @classmethod
+    def parse_into(cls, line: str, opcodes: bytearray, payloads: array[int]) -> None:
+        """parse a line like parse and append the encoded instruction without an instance"""
+        context = _LOKAL_CONTEXT
+        name, separator, args = line.partition("(")
+        if separator:
+            if not args.endswith(")"):
+                raise KeyError("invalid instruction")
+            instruction = INSTRUCTIONS[name]
+            first, separator, last = args[:-1].partition(",")
+            if separator:
+                context = CONTEXTS[first.upper()]
+                first = last
+            payload = int(first)
+        else:
+            name, separator, arg = line.partition(" ")
+            instruction = INSTRUCTIONS[name]
+            payload = int(arg) if separator else 0
+        payloads.append(cls._encode_payload(instruction, context, payload))
+        opcodes.append(instruction | context << CONTEXT_SHIFT)
+
+    @classmethod
+    def encode(cls, instruction: tuple[Instruction, MemoryContext, int]) -> tuple[int, int]:
+        """
+        encode an instance with payload as opcode (including the context) and payload,
+        validating global addresses and resolving jump targets in advance
+        """
+        return (
+            instruction[0] | instruction[1] << CONTEXT_SHIFT,
+            cls._encode_payload(*instruction)
+        )
+
+    @classmethod
+    def optimize(cls, program: Program) -> Program:
+        """replace common sequences of instructions with super instructions"""
+        return program.fuse(FUSIONS)
+
+    @staticmethod
+    def _encode_payload(instruction: Instruction, context: MemoryContext, payload: int) -> int:
+        if context is _GLOBAL_CONTEXT and payload <= 0 and instruction.has_context():
+            raise ValueError(f"address {payload} references outside the runtime stack")
+        if instruction in TARGETS:
+            return payload - 1  # index of the target instruction
+        return payload
 
     def is_jump(self) -> bool:
         """check if the instruction is a jump"""
-        return self.value in {18, 19, 25, 27}
+        return self in JUMPS
 
     def has_payload(self) -> bool:
         """check if the instruction uses its payload"""
-        return self.value > 11 and self is not Instruction.PUSH
+        return self in PAYLOADS
 
     def has_context(self) -> bool:
         """check if the instruction has a context"""
-        return self in (
-            Instruction.LOAD,
-            Instruction.LOADA,
-            Instruction.STORE,
-            Instruction.READ,
-            Instruction.WRITE
-        )
+        return self in CONTEXTUAL
+
+
+# programs accepted by the machine
+AnyProgram: TypeAlias = Sequence[tuple[Instruction, MemoryContext, int]] | Program
+
+# instructions by name, avoids the lookup machinery of the enum
+INSTRUCTIONS = {instruction.name: instruction for instruction in Instruction}
+
+# memory contexts by name
+CONTEXTS = {context.name: context for context in MemoryContext}
+
+# memory contexts used while parsing, avoids the attribute lookup of the enum
+_GLOBAL_CONTEXT = MemoryContext.GLOBAL
+_LOKAL_CONTEXT = MemoryContext.LOKAL
+
+# instructions for which the predicates hold, faster to test than bit masks of the values
+JUMPS = frozenset((Instruction.JMP, Instruction.JMC, Instruction.CALL, Instruction.RET))
+PAYLOADS = frozenset(
+    instruction for instruction in Instruction
+    if instruction > 11 and instruction is not Instruction.PUSH
+)
+CONTEXTUAL = frozenset((
+    Instruction.LOAD,
+    Instruction.LOADA,
+    Instruction.STORE,
+    Instruction.READ,
+    Instruction.WRITE
+))
 
+# instructions whose payload is a counter
+TARGETS = frozenset((Instruction.JMP, Instruction.JMC, Instruction.CALL))
 
-class Machine(AbstractMachine[tuple[Instruction, MemoryContext, int]]):
+
+# rules for Program.fuse
+FUSIONS = tuple(
+    (bytes((instruction | context, follower | LOKAL)), super_instruction | context, (0,))
+    for instruction, follower, super_instruction in (
+        (Instruction.LOAD, Instruction.PUSH, LOAD_PUSH),
+        (Instruction.LOADA, Instruction.PUSH, LOADA_PUSH),
+        (Instruction.LIT, Instruction.PUSH, LIT_PUSH),
+        (Instruction.LIT, Instruction.ADD, LIT_ADD)
+    )
+    for context in (0, LOKAL)
+)
+
+
+# change of the stack size caused by an opcode
+STACK_EFFECTS = (0,) + (-1,) * 11 + (1, 1, 1, -1, -1, 1, 0, -1, 0, 0, 0, 0, -1, 0, 0, 0)
+
+
+def max_stack_depth(opcodes: bytes) -> int:
+    """estimate the maximum stack depth of a program"""
+    depth = maximum = 0
+    for opcode in opcodes:
+        depth = max(depth + STACK_EFFECTS[opcode & ~(1 << CONTEXT_SHIFT)], 0)
+        maximum = max(depth, maximum)
+    return maximum
+
+
+def max_runtime_depth(program: Program) -> int:
+    """estimate the maximum runtime stack depth of a program without recursion"""
+    depth = 0
+    for opcode, payload in zip(program.opcodes, program.payloads):
+        instruction = opcode & ~LOKAL
+        if instruction == 25:       # CALL
+            depth += 2
+        elif instruction == 24:     # PUSH
+            depth += 1
+        elif instruction == 26:     # INIT
+            depth += max(payload, 0)
+    return depth
+
+
+class Machine(StackMachine[tuple[Instruction, MemoryContext, int]]):
     """machine for executing AM0 instructions"""
 
-    __slots__ = ("stack", "runtime_stack", "reference_pointer", "input")
+    __slots__ = ("_runtime_stack", "runtime_stack_pointer", "reference_pointer")
 
-    stack: list[int]
+    _runtime_stack: array[int]
 
-    runtime_stack: list[int]
+    runtime_stack_pointer: int
 
     reference_pointer: int
 
-    input: Iterator[int]
+    # biggest runtime stack which is preallocated for a program
+    MAX_RESERVED_RUNTIME = 1 << 16
 
-    def __init__(self, counter: int, stack: list[int], runtime_stack: list[int], reference_pointer: int, input: Iterator[int]) -> None:
+    def __init__(self, counter: int, stack: Iterable[int], runtime_stack: Iterable[int], reference_pointer: int, input: Iterator[int]) -> None:
         self.counter = counter
         self.stack = stack
         self.runtime_stack = runtime_stack
         self.reference_pointer = reference_pointer
         self.input = input
+        self.output = []
 
     @classmethod
     def default(cls, input: Iterator[int]) -> Machine:
         """create an instance with default values"""
         return cls(1, [], [], 0, input)
 
+    @classmethod
+    def default_for_program(cls, program: AnyProgram, input: Iterator[int]) -> Machine:
+        """create an instance with default values and stacks preallocated for the program"""
+        if not isinstance(program, Program):
+            try:
+                program = Instruction.compile(program)
+            except (AttributeError, IndexError, TypeError, ValueError):
+                # execute_program reports invalid instructions when reached
+                return cls.default(input)
+        program = program.unoptimized()
+        machine = cls.default(input)
+        machine.reserve(max_stack_depth(program.opcodes))
+        machine.reserve_runtime(min(max_runtime_depth(program), cls.MAX_RESERVED_RUNTIME))
+        return machine
+
+    @property
+    def runtime_stack(self) -> list[int]:
+        """values on the runtime stack from bottom to top"""
+        return self._runtime_stack[:self.runtime_stack_pointer].tolist()
+
+    @runtime_stack.setter
+    def runtime_stack(self, values: Iterable[int]) -> None:
+        self._runtime_stack = array("q", values)
+        self.runtime_stack_pointer = len(self._runtime_stack)
+
+    def reserve_runtime(self, depth: int) -> None:
+        """preallocate the runtime stack to hold depth values"""
+        if depth > len(self._runtime_stack):
+            missing = depth - len(self._runtime_stack)
+            self._runtime_stack.frombytes(bytes(self._runtime_stack.itemsize * missing))
+
     def status(self) -> Mapping[str, object]:
         """return an object mapping values to visualisations"""
         memory = "\n" + "\n".join(
@@ -150,13 +320,18 @@ class Machine(AbstractMachine[tuple[Instruction, MemoryContext, int]]):
         Yield the runtime stack split into call frames from latest to first.
         Parameters are part of the previous frame!
         """
-        previous_reference = len(self.runtime_stack) + 2
+        for frame in self.frame_ranges():
+            yield self._runtime_stack[frame.start:frame.stop].tolist()
+
+    def frame_ranges(self) -> Iterator[range]:
+        """yield the indices of the runtime stack covered by each frame like frames"""
+        previous_reference = self.runtime_stack_pointer + 2
         reference = self.reference_pointer
         while reference > 0:
-            yield self.runtime_stack[reference - 2:previous_reference - 2]
-            previous_reference, reference = reference, self.runtime_stack[reference - 1]
+            yield range(reference - 2, previous_reference - 2)
+            previous_reference, reference = reference, self._runtime_stack[reference - 1]
         if previous_reference > 2:
-            yield self.runtime_stack[:previous_reference - 2]
+            yield range(previous_reference - 2)
 
     def state(self, input: Iterable[int], output: Iterable[int]) -> str:
         """create a string representation of the current machine state"""
@@ -169,99 +344,560 @@ class Machine(AbstractMachine[tuple[Instruction, MemoryContext, int]]):
             f"{' : '.join(map(str, output)):ε<1})"
         )
 
-    def execute_instruction(self, instruction: tuple[Instruction, MemoryContext, int]) -> int | None:
-        """execute an instruction, returning the output if produced"""
-        value = None
-        match instruction:
-            case (Instruction.ADD, _, _):
-                self.stack[-2] = self.stack[-2] + self.stack[-1]
-                self.stack.pop()
-            case (Instruction.MUL, _, _):
-                self.stack[-2] = self.stack[-2] * self.stack[-1]
-                self.stack.pop()
-            case (Instruction.SUB, _, _):
-                self.stack[-2] = self.stack[-2] - self.stack[-1]
-                self.stack.pop()
-            case (Instruction.DIV, _, _):
-                self.stack[-2] = self.stack[-2] // self.stack[-1]
-                self.stack.pop()
-            case (Instruction.MOD, _, _):
-                self.stack[-2] = self.stack[-2] % self.stack[-1]
-                self.stack.pop()
-            case (Instruction.EQ, _, _):
-                self.stack[-2] = int(self.stack[-2] == self.stack[-1])
-                self.stack.pop()
-            case (Instruction.NE, _, _):
-                self.stack[-2] = int(self.stack[-2] != self.stack[-1])
-                self.stack.pop()
-            case (Instruction.LT, _, _):
-                self.stack[-2] = int(self.stack[-2] < self.stack[-1])
-                self.stack.pop()
-            case (Instruction.GT, _, _):
-                self.stack[-2] = int(self.stack[-2] > self.stack[-1])
-                self.stack.pop()
-            case (Instruction.LE, _, _):
-                self.stack[-2] = int(self.stack[-2] <= self.stack[-1])
-                self.stack.pop()
-            case (Instruction.GE, _, _):
-                self.stack[-2] = int(self.stack[-2] >= self.stack[-1])
-                self.stack.pop()
-            case (Instruction.LOAD, context, address):
-                index = context.resolve_address(address, self.reference_pointer) - 1
-                self.stack.append(self.runtime_stack[index])
-            case (Instruction.LOADA, context, address):
-                self.stack.append(context.resolve_address(address, self.reference_pointer))
-            case (Instruction.LOADI, _, address):
-                index = MemoryContext.LOKAL.resolve_address(address, self.reference_pointer) - 1
-                self.stack.append(self.runtime_stack[self.runtime_stack[index] - 1])
-            case (Instruction.STORE, context, address):
-                self.runtime_stack[context.resolve_address(address, self.reference_pointer) - 1] = self.stack.pop()
-            case (Instruction.STOREI, _, address):
-                index = MemoryContext.LOKAL.resolve_address(address, self.reference_pointer) - 1
-                self.runtime_stack[self.runtime_stack[index] - 1] = self.stack.pop()
-            case (Instruction.LIT, _, literal):
-                self.stack.append(literal)
-            case (Instruction.JMP, _, counter):
-                self.counter = counter - 1
-            case (Instruction.JMC, _, counter):
-                if self.stack.pop() == 0:
-                    self.counter = counter - 1
-            case (Instruction.WRITE, context, address):
-                index = context.resolve_address(address, self.reference_pointer) - 1
-                value = self.runtime_stack[index]
-            case (Instruction.WRITEI, _, address):
-                index = MemoryContext.LOKAL.resolve_address(address, self.reference_pointer) - 1
-                value = self.runtime_stack[self.runtime_stack[index] - 1]
-            case (Instruction.READ, context, address):
-                index = context.resolve_address(address, self.reference_pointer) - 1
-                self.runtime_stack[index] = next(self.input)
-            case (Instruction.READI, _, address):
-                index = MemoryContext.LOKAL.resolve_address(address, self.reference_pointer) - 1
-                self.runtime_stack[self.runtime_stack[index] - 1] = next(self.input)
-            case (Instruction.PUSH, _, _):
-                self.runtime_stack.append(self.stack.pop())
-            case (Instruction.CALL, _, counter):
-                self.runtime_stack.append(self.counter + 1)
-                self.runtime_stack.append(self.reference_pointer)
-                self.counter = counter - 1
-                self.reference_pointer = len(self.runtime_stack)
-            case (Instruction.INIT, _, variables):
-                self.runtime_stack.extend(repeat(0, variables))
-            case (Instruction.RET, _, parameters) if self.reference_pointer > 1:
-                old_reference = self.reference_pointer
-                self.counter = self.runtime_stack[self.reference_pointer - 2] - 1
-                self.reference_pointer = self.runtime_stack[self.reference_pointer - 1]
-                del self.runtime_stack[old_reference - parameters - 2:]
-            case (Instruction.RET, _, _):
-                raise LookupError("stack is too small to return")
-            case invalid:
-                raise ValueError(f"invalid instruction: '{invalid}'")
-        self.counter += 1
-        return value
+    def execute_program_jit(self, program: AnyProgram) -> list[int]:
+        """
+        Execute a program like run, using jit_run for every instruction
+        it can execute (only worth it if Numba is installed).
+        """
+        if not isinstance(program, Program):
+            program = Instruction.compile(program)
+        program = program.unoptimized()    # jit_run does not know super instructions
+        # avoid leaving jit_run to grow the stacks
+        self.reserve(max_stack_depth(program.opcodes))
+        self.reserve_runtime(
+            self.runtime_stack_pointer + min(max_runtime_depth(program), self.MAX_RESERVED_RUNTIME)
+        )
+        handlers = self._HANDLERS
+        opcodes = program.opcodes
+        payloads = program.payloads
+        output = array("q", bytes(8 * 64))
+        registers = array(
+            "q",
+            (1, self.stack_pointer, self.runtime_stack_pointer, self.reference_pointer, 0, 0)
+        )
+        while True:
+            jit_run(
+                opcodes, payloads, self._stack, self._runtime_stack, array("q"), output, registers
+            )
+            self.output.extend(output[:registers[5]])
+            self.counter = registers[0]
+            self.stack_pointer = registers[1]
+            self.runtime_stack_pointer = registers[2]
+            self.reference_pointer = registers[3]
+            pc = self.counter - 1
+            if not 0 <= pc < len(opcodes):
+                break
+            # input, growing the stacks and errors are handled by the interpreter
+            pc = handlers[opcodes[pc]](self, payloads[pc], pc)
+            registers[0] = self.counter = pc + 1
+            registers[1] = self.stack_pointer
+            registers[2] = self.runtime_stack_pointer
+            registers[3] = self.reference_pointer
+            registers[5] = 0
+        values = self.output
+        self.output = []
+        return values
+
+    def _load_global(self, address: int, pc: int) -> int:
+        self._push(self._runtime_stack[self._global(address)])
+        return pc + 1
+
+    def _load_lokal(self, address: int, pc: int) -> int:
+        self._push(self._runtime_stack[self._lokal(address)])
+        return pc + 1
+
+    def _loada_global(self, address: int, pc: int) -> int:
+        self._push(address)
+        return pc + 1
+
+    def _loada_lokal(self, address: int, pc: int) -> int:
+        address += self.reference_pointer
+        if address <= 0:
+            raise ValueError(
+                f"address {address} references outside the runtime stack "
+                f"(reference pointer: {self.reference_pointer})"
+            )
+        self._push(address)
+        return pc + 1
+
+    def _loadi(self, address: int, pc: int) -> int:
+        self._push(self._runtime_stack[self._indirect(address)])
+        return pc + 1
+
+    def _store_global(self, address: int, pc: int) -> int:
+        self._runtime_stack[self._global(address)] = self._pop()
+        return pc + 1
+
+    def _store_lokal(self, address: int, pc: int) -> int:
+        self._runtime_stack[self._lokal(address)] = self._pop()
+        return pc + 1
+
+    def _storei(self, address: int, pc: int) -> int:
+        self._runtime_stack[self._indirect(address)] = self._pop()
+        return pc + 1
+
+    def _lit(self, literal: int, pc: int) -> int:
+        self._push(literal)
+        return pc + 1
+
+    def _jmp(self, target: int, pc: int) -> int:
+        return target
+
+    def _jmc(self, target: int, pc: int) -> int:
+        if self._pop() == 0:
+            return target
+        return pc + 1
+
+    def _write_global(self, address: int, pc: int) -> int:
+        self.output.append(self._runtime_stack[self._global(address)])
+        return pc + 1
+
+    def _write_lokal(self, address: int, pc: int) -> int:
+        self.output.append(self._runtime_stack[self._lokal(address)])
+        return pc + 1
+
+    def _writei(self, address: int, pc: int) -> int:
+        self.output.append(self._runtime_stack[self._indirect(address)])
+        return pc + 1
+
+    def _read_global(self, address: int, pc: int) -> int:
+        self._runtime_stack[self._global(address)] = next(self.input)
+        return pc + 1
+
+    def _read_lokal(self, address: int, pc: int) -> int:
+        self._runtime_stack[self._lokal(address)] = next(self.input)
+        return pc + 1
+
+    def _readi(self, address: int, pc: int) -> int:
+        self._runtime_stack[self._indirect(address)] = next(self.input)
+        return pc + 1
+
+    def _push_value(self, _: int, pc: int) -> int:
+        self._push_runtime(self._pop())
+        return pc + 1
+
+    def _call(self, target: int, pc: int) -> int:
+        runtime_stack = self._runtime_stack
+        pointer = self.runtime_stack_pointer + 2
+        if pointer > len(runtime_stack):
+            runtime_stack.frombytes(bytes(runtime_stack.itemsize * (pointer - len(runtime_stack))))
+        runtime_stack[pointer - 2] = pc + 2     # counter of the next instruction
+        runtime_stack[pointer - 1] = self.reference_pointer
+        self.runtime_stack_pointer = self.reference_pointer = pointer
+        return target
+
+    def _init(self, variables: int, pc: int) -> int:
+        start = self.runtime_stack_pointer
+        self.runtime_stack_pointer += max(variables, 0)
+        self._runtime_stack[start:self.runtime_stack_pointer] = array(
+            "q",
+            bytes(self._runtime_stack.itemsize * (self.runtime_stack_pointer - start))
+        )
+        return pc + 1
+
+    def _ret(self, parameters: int, pc: int) -> int:
+        old_reference = self.reference_pointer
+        if not 2 <= old_reference <= self.runtime_stack_pointer:
+            raise LookupError("reference pointer does not point to a call frame")
+        self.reference_pointer = self._runtime_stack[old_reference - 1]
+        # negative parameters must not grow the runtime stack
+        self.runtime_stack_pointer = min(
+            max(old_reference - parameters - 2, 0),
+            self.runtime_stack_pointer
+        )
+        return self._runtime_stack[old_reference - 2] - 1
+
+    def _load_push_global(self, address: int, pc: int) -> int:
+        self._push_runtime(self._runtime_stack[self._global(address)])
+        return pc + 2
+
+    def _load_push_lokal(self, address: int, pc: int) -> int:
+        self._push_runtime(self._runtime_stack[self._lokal(address)])
+        return pc + 2
+
+    def _loada_push_global(self, address: int, pc: int) -> int:
+        self._push_runtime(address)
+        return pc + 2
+
+    def _loada_push_lokal(self, address: int, pc: int) -> int:
+        address += self.reference_pointer
+        if address <= 0:
+            raise ValueError(
+                f"address {address} references outside the runtime stack "
+                f"(reference pointer: {self.reference_pointer})"
+            )
+        self._push_runtime(address)
+        return pc + 2
+
+    def _lit_push(self, literal: int, pc: int) -> int:
+        self._push_runtime(literal)
+        return pc + 2
+
+    _INSTRUCTION = Instruction
+
+    # indexed by the opcode, instructions with a context have a variant for each one
+    _HANDLERS: tuple[Callable[[Machine, int, int], int], ...] = StackMachine._BINARY_HANDLERS + (
+        _load_global,
+        _loada_global,
+        _loadi,
+        _store_global,
+        _storei,
+        _lit,
+        _jmp,
+        _jmc,
+        _write_global,
+        _writei,
+        _read_global,
+        _readi,
+        _push_value,
+        _call,
+        _init,
+        _ret
+    ) + (StackMachine._invalid,) * (LOAD_PUSH - 28) + (
+        _load_push_global,
+        _loada_push_global,
+        _lit_push,
+        StackMachine._lit_add
+    ) + (StackMachine._invalid,) * (LOKAL - LIT_ADD - 1) + (
+        StackMachine._BINARY_HANDLERS
+    ) + (
+        _load_lokal,
+        _loada_lokal,
+        _loadi,
+        _store_lokal,
+        _storei,
+        _lit,
+        _jmp,
+        _jmc,
+        _write_lokal,
+        _writei,
+        _read_lokal,
+        _readi,
+        _push_value,
+        _call,
+        _init,
+        _ret
+    ) + (StackMachine._invalid,) * (LOAD_PUSH - 28) + (
+        _load_push_lokal,
+        _loada_push_lokal,
+        _lit_push,
+        StackMachine._lit_add
+    ) + (StackMachine._invalid,) * (LOKAL - LIT_ADD - 1)
+
+    def _push_runtime(self, value: int) -> None:
+        try:
+            self._runtime_stack[self.runtime_stack_pointer] = value
+        except IndexError:
+            self._runtime_stack.append(value)
+        self.runtime_stack_pointer += 1
+
+    def _global(self, address: int) -> int:
+        """resolve a global address to an index of the runtime stack"""
+        if not 0 < address <= self.runtime_stack_pointer:
+            raise IndexError(f"address {address} references outside the runtime stack")
+        return address - 1
+
+    def _lokal(self, address: int) -> int:
+        """resolve a lokal address to an index of the runtime stack"""
+        absolute = address + self.reference_pointer
+        if not 0 < absolute <= self.runtime_stack_pointer:
+            if absolute <= 0:
+                raise ValueError(
+                    f"address {absolute} references outside the runtime stack "
+                    f"(reference pointer: {self.reference_pointer})"
+                )
+            raise IndexError(f"address {absolute} references outside the runtime stack")
+        return absolute - 1
+
+    def _indirect(self, address: int) -> int:
+        """resolve a lokal address storing an absolute address to an index of the runtime stack"""
+        index = self._runtime_stack[self._lokal(address)] - 1
+        if index < 0:   # count from the top of the runtime stack like list indices
+            index += self.runtime_stack_pointer
+        if not 0 <= index < self.runtime_stack_pointer:
+            raise IndexError("indirect address references outside the runtime stack")
+        return index
 
     def reset(self) -> None:
         """reset the machine to the default state"""
         self.counter = 1
-        self.stack.clear()
-        self.runtime_stack.clear()
+        self.stack_pointer = 0
+        self.runtime_stack_pointer = 0
         self.reference_pointer = 0
+        self.output.clear()
+
+
+@jit(cache=True, boundscheck=False)
+def jit_run(
+    opcodes: bytes,
+    payloads: array[int],
+    stack: array[int],
+    runtime_stack: array[int],
+    input: array[int],
+    output: array[int],
+    registers: array[int]
+) -> None:
+    """
+    Execute a compiled program without super instructions until it halts or reaches
+    an instruction which can not be executed with the provided buffers (or would fail or overflow).
+    The registers hold the counter, stack pointer, runtime stack pointer, reference pointer,
+    input position and output position and are updated in place.
+    """
+    pc, pointer = registers[0] - 1, registers[1]
+    runtime_pointer, reference = registers[2], registers[3]
+    read, written = registers[4], registers[5]
+    size = len(opcodes)
+    while 0 <= pc < size:
+        opcode = opcodes[pc]
+        payload = payloads[pc]
+        instruction = opcode & 127
+        if instruction <= 11:
+            if pointer < 2:
+                break
+            left = stack[pointer - 2]
+            right = stack[pointer - 1]
+            # overflows are left to the interpreter like division by zero
+            if instruction == 1:
+                if (
+                    (right > 0 and left > MAX_VALUE - right)
+                    or (right < 0 and left < MIN_VALUE - right)
+                ):
+                    break
+                left = left + right
+            elif instruction == 2:
+                if abs(float(left) * float(right)) >= 0x4000000000000000:    # close to the limits
+                    break
+                left = left * right
+            elif instruction == 3:
+                if (
+                    (right < 0 and left > MAX_VALUE + right)
+                    or (right > 0 and left < MIN_VALUE + right)
+                ):
+                    break
+                left = left - right
+            elif instruction == 4:
+                if right == 0 or (right == -1 and left == MIN_VALUE):
+                    break
+                left = left // right
+            elif instruction == 5:
+                if right == 0 or (right == -1 and left == MIN_VALUE):
+                    break
+                left = left % right
+            elif instruction == 6:
+                left = int(left == right)
+            elif instruction == 7:
+                left = int(left != right)
+            elif instruction == 8:
+                left = int(left < right)
+            elif instruction == 9:
+                left = int(left > right)
+            elif instruction == 10:
+                left = int(left <= right)
+            elif instruction == 11:
+                left = int(left >= right)
+            else:
+                break
+            stack[pointer - 2] = left
+            pointer -= 1
+        elif instruction in (12, 13, 15, 20, 22):   # contextual
+            address = payload + reference * (opcode >> 7)
+            if instruction == 13:
+                if address <= 0 or pointer >= len(stack):
+                    break
+                stack[pointer] = address
+                pointer += 1
+            elif not 0 < address <= runtime_pointer:
+                break
+            elif instruction == 12:
+                if pointer >= len(stack):
+                    break
+                stack[pointer] = runtime_stack[address - 1]
+                pointer += 1
+            elif instruction == 15:
+                if pointer < 1:
+                    break
+                pointer -= 1
+                runtime_stack[address - 1] = stack[pointer]
+            elif instruction == 20:
+                if written >= len(output):
+                    break
+                output[written] = runtime_stack[address - 1]
+                written += 1
+            else:
+                if read >= len(input):
+                    break
+                runtime_stack[address - 1] = input[read]
+                read += 1
+        elif instruction in (14, 16, 21, 23):   # indirect
+            address = payload + reference
+            if not 0 < address <= runtime_pointer:
+                break
+            index = runtime_stack[address - 1] - 1
+            if index < 0:
+                index += runtime_pointer
+            if not 0 <= index < runtime_pointer:
+                break
+            if instruction == 14:
+                if pointer >= len(stack):
+                    break
+                stack[pointer] = runtime_stack[index]
+                pointer += 1
+            elif instruction == 16:
+                if pointer < 1:
+                    break
+                pointer -= 1
+                runtime_stack[index] = stack[pointer]
+            elif instruction == 21:
+                if written >= len(output):
+                    break
+                output[written] = runtime_stack[index]
+                written += 1
+            else:
+                if read >= len(input):
+                    break
+                runtime_stack[index] = input[read]
+                read += 1
+        elif instruction == 17:
+            if pointer >= len(stack):
+                break
+            stack[pointer] = payload
+            pointer += 1
+        elif instruction == 18:
+            pc = payload
+            continue
+        elif instruction == 19:
+            if pointer < 1:
+                break
+            pointer -= 1
+            if stack[pointer] == 0:
+                pc = payload
+                continue
+        elif instruction == 24:
+            if pointer < 1 or runtime_pointer >= len(runtime_stack):
+                break
+            pointer -= 1
+            runtime_stack[runtime_pointer] = stack[pointer]
+            runtime_pointer += 1
+        elif instruction == 25:
+            if runtime_pointer + 2 > len(runtime_stack):
+                break
+            runtime_stack[runtime_pointer] = pc + 2     # counter of the next instruction
+            runtime_stack[runtime_pointer + 1] = reference
+            runtime_pointer += 2
+            reference = runtime_pointer
+            pc = payload
+            continue
+        elif instruction == 26:
+            end = runtime_pointer + max(payload, 0)
+            if end > len(runtime_stack):
+                break
+            while runtime_pointer < end:
+                runtime_stack[runtime_pointer] = 0
+                runtime_pointer += 1
+        elif instruction == 27:
+            previous = reference
+            if not 2 <= previous <= runtime_pointer:
+                break
+            reference = runtime_stack[previous - 1]
+            runtime_pointer = min(max(previous - payload - 2, 0), runtime_pointer)
+            pc = runtime_stack[previous - 2] - 1
+            continue
+        else:
+            break
+        pc += 1
+    registers[0] = pc + 1
+    registers[1] = pointer
+    registers[2] = runtime_pointer
+    registers[3] = reference
+    registers[4] = read
+    registers[5] = written
+
+
+# python statements implementing an instruction, indented relative to the block
+_TEMPLATES: dict[int, str] = {
+    Instruction.ADD: "right = stack.pop()\nstack[-1] = stack[-1] + right",
+    Instruction.MUL: "right = stack.pop()\nstack[-1] = stack[-1] * right",
+    Instruction.SUB: "right = stack.pop()\nstack[-1] = stack[-1] - right",
+    Instruction.DIV: "right = stack.pop()\nstack[-1] = stack[-1] // right",
+    Instruction.MOD: "right = stack.pop()\nstack[-1] = stack[-1] % right",
+    Instruction.EQ: "right = stack.pop()\nstack[-1] = int(stack[-1] == right)",
+    Instruction.NE: "right = stack.pop()\nstack[-1] = int(stack[-1] != right)",
+    Instruction.LT: "right = stack.pop()\nstack[-1] = int(stack[-1] < right)",
+    Instruction.GT: "right = stack.pop()\nstack[-1] = int(stack[-1] > right)",
+    Instruction.LE: "right = stack.pop()\nstack[-1] = int(stack[-1] <= right)",
+    Instruction.GE: "right = stack.pop()\nstack[-1] = int(stack[-1] >= right)",
+    Instruction.LOAD: "stack.append(runtime[{0} - 1])",
+    Instruction.LOAD | LOKAL: "stack.append(runtime[reference + {0} - 1])",
+    Instruction.LOADA: "stack.append({0})",
+    Instruction.LOADA | LOKAL: "stack.append(reference + {0})",
+    Instruction.LOADI: "stack.append(runtime[runtime[reference + {0} - 1] - 1])",
+    Instruction.STORE: "runtime[{0} - 1] = stack.pop()",
+    Instruction.STORE | LOKAL: "runtime[reference + {0} - 1] = stack.pop()",
+    Instruction.STOREI: "runtime[runtime[reference + {0} - 1] - 1] = stack.pop()",
+    Instruction.LIT: "stack.append({0})",
+    Instruction.JMP: "counter = {0}\ncontinue",
+    Instruction.JMC: "if stack.pop() == 0:\n    counter = {0}\n    continue",
+    Instruction.WRITE: "output.append(runtime[{0} - 1])",
+    Instruction.WRITE | LOKAL: "output.append(runtime[reference + {0} - 1])",
+    Instruction.WRITEI: "output.append(runtime[runtime[reference + {0} - 1] - 1])",
+    Instruction.READ: "runtime[{0} - 1] = next(input)",
+    Instruction.READ | LOKAL: "runtime[reference + {0} - 1] = next(input)",
+    Instruction.READI: "runtime[runtime[reference + {0} - 1] - 1] = next(input)",
+    Instruction.PUSH: "runtime.append(stack.pop())",
+    Instruction.CALL: (
+        "runtime.append({1})\nruntime.append(reference)\n"
+        "reference = len(runtime)\ncounter = {0}\ncontinue"
+    ),
+    Instruction.INIT: "runtime.extend([0] * {0})",
+    Instruction.RET: (
+        "if not 2 <= reference <= len(runtime):\n"
+        "    raise LookupError('reference pointer does not point to a call frame')\n"
+        "counter = runtime[reference - 2]\nprevious = reference\n"
+        "reference = runtime[previous - 1]\n"
+        "del runtime[max(previous - {0} - 2, 0):]\ncontinue"
+    )
+}
+for _instruction in Instruction:
+    if not _instruction.has_context():
+        _TEMPLATES[_instruction | LOKAL] = _TEMPLATES[_instruction]
+
+
+@lru_cache(maxsize=PROGRAM_CACHE_SIZE)
+def compile_to_python(program: Program) -> CodeType:
+    """
+    Translate a compiled program into the code of a python module defining
+    a function 'run(stack, runtime_stack, reference_pointer, input, output)' which executes it
+    with lists as stacks and returns the final reference pointer.
+    Instructions between jump targets and return addresses are executed as straight line code,
+    only jumps go through the counter.
+    Results are cached and shared between callers.
+    """
+    program = program.unoptimized()
+    size = len(program)
+    leaders = {1}
+    for number, (opcode, payload) in enumerate(zip(program.opcodes, program.payloads), start=1):
+        instruction = opcode & ~LOKAL
+        if instruction in JUMPS:
+            leaders.add(number + 1)
+            if instruction in TARGETS and 0 < payload + 1 <= size:
+                leaders.add(payload + 1)
+    lines = [
+        "def run(stack, runtime, reference, input, output):",
+        "    counter = 1",
+        "    while True:"
+    ]
+    for number, (opcode, payload) in enumerate(zip(program.opcodes, program.payloads), start=1):
+        if number in leaders:
+            if number > 1:
+                lines.append(f"            counter = {number}")
+            lines.append(f"        if counter == {number}:")
+        try:
+            template = _TEMPLATES[opcode]
+        except KeyError:
+            template = "raise ValueError('invalid opcode')"
+        if (opcode & ~LOKAL) in TARGETS:
+            payload += 1
+        elif payload <= 0 and "reference + {0}" in template:
+            template = (
+                "if reference + {0} <= 0:\n"
+                "    raise ValueError('address references outside the runtime stack')\n"
+            ) + template
+        lines.extend(
+            "            " + line for line in template.format(payload, number + 1).split("\n")
+        )
+    if size:
+        lines.append(f"            counter = {size + 1}")
+    lines.append(f"        if 0 < counter <= {size}:")
+    lines.append("            raise ValueError('return address is not the end of a call')")
+    lines.append("        return reference")
+    return compile("\n".join(lines), "<am1>", "exec")
@@ -0,0 +1,38 @@
+#!/usr/bin/python3
+
+"""Optional compilation of kernels with Numba"""
+
+from __future__ import annotations
+from collections.abc import Callable
+from functools import wraps
+from typing import Any, TypeVar, ParamSpec
+
+__all__ = (
+    "jit",
+)
+
+P = ParamSpec("P")
+R = TypeVar("R")
+
+
+def jit(**options: Any) -> Callable[[Callable[P, R]], Callable[P, R]]:
+    """
+    Compile a function with numba.njit on its first call.
+    If Numba is not installed the function is executed by the interpreter.
+    """
+    def decorator(function: Callable[P, R]) -> Callable[P, R]:
+        compiled: Callable[P, R] | None = None
+
+        @wraps(function)
+        def wrapper(*args: P.args, **kwargs: P.kwargs) -> R:
+            nonlocal compiled
+            if compiled is None:
+                try:
+                    from numba import njit  # pylint: disable=import-outside-toplevel
+                except ImportError:
+                    compiled = function
+                else:
+                    compiled = njit(**options)(function)
+            return compiled(*args, **kwargs)
+        return wrapper
+    return decorator
@@ -5,8 +5,8 @@
 import sys
 from typing import Type, TypeVar, Any, cast
 from argparse import ArgumentParser, FileType, Namespace
-from itertools import repeat
-from . import __doc__, __version__, AbstractInstruction, AbstractMachine
+from collections.abc import Iterator, Sequence
+from . import __doc__, __version__, AbstractInstruction, AbstractMachine, Program
 from .am0 import Instruction as AM0Instruction, Machine as AM0Machine
 from .am1 import Instruction as AM1Instruction, Machine as AM1Machine
 from .repl import REPL
@@ -19,6 +19,12 @@ __all__ = (
 
 T = TypeVar("T")
 
+# number of states written at once by the trace subcommand
+TRACE_BUFFER_SIZE = 256
+
+# error printed when a value does not fit into the stacks and memories of a machine
+OVERFLOW_MESSAGE = "Error while executing instruction {0}: value out of the 64 bit range ({1})"
+
 MACHINES: dict[str, tuple[Type[AbstractInstruction[Any]], Type[AbstractMachine[Any]]]] = {
     "AM0": (AM0Instruction, AM0Machine),
     "AM1": (AM1Instruction, AM1Machine)
@@ -32,20 +38,36 @@ def main() -> int:
     return cast(int, args.main(Instruction, Machine, args))
 
 
+def read_input() -> Iterator[int]:
+    """read the input of a machine from stdin when needed"""
+    return iter(lambda: int(input("Input: ")), None)
+
+
 def main_repl(instruction: Type[AbstractInstruction[T]], machine: Type[AbstractMachine[T]], args: Namespace) -> int:
     """entry point for the repl subcommand"""
-    repl = REPL(instruction, machine.default(map(int, map(input, repeat("Input: ")))))
+    repl = REPL(instruction, machine.default(read_input()))
     repl.cmdloop(f"Welcome the the {args.instructions.upper()} REPL, type 'help' for help")
     return 0
 
 
 def main_exec(instruction: Type[AbstractInstruction[T]], machine: Type[AbstractMachine[T]], args: Namespace) -> int:
     """entry point for the exec subcommand"""
-    program = tuple(instruction.parse_program(args.file.read()))
-    _machine = machine.default(map(int, map(input, repeat("Input: "))))
-    for value in _machine.execute_program(program):
-        if value is not None:
-            print(f"Output: {value}")
+    program: Sequence[T] | Program
+    if args.no_optimize:
+        program = tuple(instruction.parse_program(args.file.read()))
+    else:
+        program = instruction.compile_program(args.file.read())
+    if args.interactive:    # the REPL may use any address and stack depth
+        _machine = machine.default(read_input())
+    else:
+        _machine = machine.default_for_program(program, read_input())
+    try:
+        for value in _machine.execute_program(program):
+            if value is not None:
+                print(f"Output: {value}")
+    except OverflowError as error:
+        print(OVERFLOW_MESSAGE.format(_machine.counter, error), file=sys.stderr)
+        return 1
     if args.interactive:
         repl = REPL(instruction, _machine)
         repl.cmdloop(f"Welcome the the {args.instructions.upper()} REPL, type 'help' for help")
@@ -54,15 +76,24 @@ def main_exec(instruction: Type[AbstractInstruction[T]], machine: Type[AbstractM
 
 def main_trace(instruction: Type[AbstractInstruction[T]], machine: Type[AbstractMachine[T]], args: Namespace) -> int:
     """entry point for the trace subcommand"""
-    program = tuple(instruction.parse_program(args.file.read()))
+    program = instruction.compile_program(args.file.read(), optimize=False)
     output: list[int] = []
     args.input.reverse()
     _machine = machine.default(args.input.pop() for _ in reversed(args.input))
-    sys.stderr.write(f"{_machine.state(reversed(args.input), output)}\n")
-    for value in _machine.execute_program(program):
-        if value is not None:
-            output.append(value)
-        sys.stderr.write(f"{_machine.state(reversed(args.input), output)}\n")
+    lines = [f"{_machine.state(reversed(args.input), output)}\n"]
+    try:
+        for value in _machine.execute_program(program):
+            if value is not None:
+                output.append(value)
+            lines.append(f"{_machine.state(reversed(args.input), output)}\n")
+            if len(lines) >= TRACE_BUFFER_SIZE:
+                sys.stderr.writelines(lines)
+                lines.clear()
+    except OverflowError as error:
+        lines.append(f"{OVERFLOW_MESSAGE.format(_machine.counter, error)}\n")
+        return 1
+    finally:
+        sys.stderr.writelines(lines)
     return 0
 
 
@@ -100,6 +131,11 @@ EXEC_PARSER.add_argument(
     action="store_true",
     help="open the REPL after executing the program"
 )
+EXEC_PARSER.add_argument(
+    "--no-optimize",
+    action="store_true",
+    help="execute the program without fusing common instruction sequences into super instructions"
+)
 EXEC_PARSER.set_defaults(main=main_exec)
 
 TRACE_PARSER = SUBCOMMANDS.add_parser("trace", help="trace the execution of a program")
@@ -4,6 +4,7 @@
 
 from __future__ import annotations
 from cmd import Cmd
+from collections.abc import Callable
 from typing import Type, TypeVar, Generic, Any
 from . import AbstractInstruction, AbstractMachine
 
@@ -21,11 +22,31 @@ class REPL(Generic[T], Cmd):
 
     machine: AbstractMachine[T]
 
+    continuation_prompt: str
+
+    commands: dict[str, Callable[[str], bool]]
+
     def __init__(self, instruction: Type[AbstractInstruction[T]], machine: AbstractMachine[T], *args: Any, **kwargs: Any) -> None:
         super().__init__(*args, **kwargs)
         self.instruction = instruction
         self.machine = machine
         self.prompt = "AMN >> "
+        self.continuation_prompt = "... "
+        self.commands = {
+            name: getattr(self, f"do_{name}")
+            for name in ("exec", "run", "reset", "status", "state", "exit")
+        }
+
+    def onecmd(self, line: str) -> bool:
+        """execute a command, looking up the common ones without the generic parsing of cmd.Cmd"""
+        line = line.strip()
+        command, _, arg = line.partition(" ")
+        try:
+            handler = self.commands[command]
+        except KeyError:
+            return super().onecmd(line)
+        self.lastcmd = line
+        return handler(arg.strip())
 
     def emptyline(self) -> bool:
         """ignore empty lines"""
@@ -37,14 +58,50 @@ class REPL(Generic[T], Cmd):
             instruction = self.instruction.parse(arg)
         except Exception as error:
             self.stdout.write(f"Error while parsing: {error!r}\n")
+        else:
+            self.execute(instruction)
+        return False
+
+    def execute(self, instruction: T) -> None:
+        """execute an instruction and print the output"""
+        try:
+            output = self.machine.execute_instruction(instruction)
+        except (ArithmeticError, LookupError, ValueError) as error:
+            self.stdout.write(f"Error while executing: {error!r}\n")
+        else:
+            if output is not None:
+                self.stdout.write(f"Output: {output}\n")
+
+    def do_run(self, _: object) -> bool:
+        """execute a program consisting of the following lines until a line containing only '.'"""
+        lines = []
+        while True:
+            if self.use_rawinput:
+                try:
+                    line = input(self.continuation_prompt)
+                except EOFError:
+                    break
+            else:
+                self.stdout.write(self.continuation_prompt)
+                self.stdout.flush()
+                line = self.stdin.readline()
+                if not line:
+                    break
+            line = line.rstrip("\r\n")
+            if line == ".":
+                break
+            lines.append(line)
+        try:
+            program = self.instruction.compile_program("\n".join(lines))
+        except Exception as error:
+            self.stdout.write(f"Error while parsing: {error!r}\n")
         else:
             try:
-                output = self.machine.execute_instruction(instruction)
-            except (LookupError, ValueError) as error:
+                for output in self.machine.execute_program(program):
+                    if output is not None:
+                        self.stdout.write(f"Output: {output}\n")
+            except (ArithmeticError, LookupError, ValueError) as error:
                 self.stdout.write(f"Error while executing: {error!r}\n")
-            else:
-                if output is not None:
-                    self.stdout.write(f"Output: {output}\n")
         return False
 
     def do_reset(self, _: object) -> bool:
@@ -54,8 +111,9 @@ class REPL(Generic[T], Cmd):
 
     def do_status(self, _: object) -> bool:
         """print the current status of the machine"""
-        for key, value in self.machine.status().items():
-            self.stdout.write(f"{key}: {value}\n")
+        self.stdout.writelines(
+            [f"{key}: {value}\n" for key, value in self.machine.status().items()]
+        )
         return False
 
     def do_state(self, _: object) -> bool:
@@ -64,8 +122,13 @@ class REPL(Generic[T], Cmd):
         return False
 
     def default(self, line: str) -> None:
-        """print an error"""
-        self.stdout.write(f"*** Unknown command: {line}\n")
+        """execute lines starting with an instruction like exec, print an error otherwise"""
+        try:
+            instruction = self.instruction.parse(line)
+        except Exception:
+            self.stdout.write(f"*** Unknown command: {line}\n")
+        else:
+            self.execute(instruction)
 
     def do_EOF(self, arg: str) -> bool:
         """exit the repl"""
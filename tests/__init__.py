@@ -1,3 +1,32 @@
 #!/usr/bin/python3
 
 """Tests for the AMN package"""
+
+from __future__ import annotations
+from collections.abc import Callable, Iterable
+from typing import Type, TypeVar, Any
+from unittest import TestCase
+from AMN import AbstractMachine, Program
+
+M = TypeVar("M", bound=AbstractMachine[Any])
+
+
+def assert_same_execution(
+    test: TestCase,
+    machine: Type[M],
+    program: Program,
+    values: Iterable[int],
+    output: list[int],
+    execute: Callable[[M, Program], list[int]],
+    reference: Callable[[M, Program], list[int]]
+) -> None:
+    """
+    Execute a program with execute and reference on two machines created for it,
+    asserting that both write output and end in the same state.
+    """
+    values = tuple(values)
+    first = machine.default_for_program(program, iter(values))
+    second = machine.default_for_program(program, iter(values))
+    test.assertEqual(execute(first, program), output)
+    test.assertEqual(reference(second, program), output)
+    test.assertEqual(first.state([], []), second.state([], []))
@@ -2,8 +2,12 @@
 
 """AM0 Tests"""
 
+from array import array
+from typing import Any
 from unittest import TestCase
-from AMN.am0 import Machine, Instruction
+from AMN import pack_operands, unpack_operands
+from AMN.am0 import Machine, Instruction, jit_run, compile_to_python, max_stack_depth, memory_addresses, LIT_STORE, LOAD_LOAD_LE, LOAD_LIT_ADD
+from . import assert_same_execution
 
 
 # do not remove trailing whitespace!
@@ -88,6 +92,7 @@ class InstructionTest(TestCase):
             Instruction.parse("ADD"),
             (Instruction.ADD, 0)
         )
+        self.assertEqual(Instruction.parse("ADD"), (1, 0))
         self.assertEqual(
             Instruction.parse("JMP 42"),
             (Instruction.JMP, 42)
@@ -133,6 +138,44 @@ class InstructionTest(TestCase):
         with self.assertRaises(ValueError):
             list(Instruction.parse_program("LOAD 1;\n ADD;\nJMP 3;"))
 
+    def test_compile_program(self) -> None:
+        """test program compilation"""
+        program = Instruction.compile_program(EXAMPLE_PROGRAM1, optimize=False)
+        self.assertEqual(
+            program,
+            Instruction.compile(Instruction.parse_program(EXAMPLE_PROGRAM1))
+        )
+        self.assertEqual(
+            list(zip(program.opcodes, program.payloads)),
+            [
+                (instruction.value, payload - 1 if instruction.is_jump() else payload)
+                for instruction, payload in Instruction.parse_program(EXAMPLE_PROGRAM1)
+            ]
+        )
+        self.assertIs(Instruction.compile_program(EXAMPLE_PROGRAM1, optimize=False), program)
+        self.assertEqual(len(Instruction.compile_program("")), 0)
+        with self.assertRaises(ValueError):
+            Instruction.compile_program(f"LIT {2 ** 63};")
+
+    def test_optimize(self) -> None:
+        """test replacing instructions with super instructions"""
+        program = Instruction.compile_program(EXAMPLE_PROGRAM1, optimize=False)
+        optimized = Instruction.optimize(program)
+        self.assertIs(optimized.unoptimized(), program)
+        self.assertEqual(len(optimized), len(program))
+        self.assertEqual(optimized.opcodes[1], LIT_STORE)
+        self.assertEqual(unpack_operands(optimized.payloads[1]), (1, 1))
+        self.assertEqual(optimized.opcodes[2], Instruction.STORE.value)
+        self.assertEqual(optimized.opcodes[5], LOAD_LOAD_LE)
+        self.assertEqual(unpack_operands(optimized.payloads[5]), (1, 2))
+        self.assertEqual(optimized.opcodes[15], LOAD_LIT_ADD)
+        self.assertEqual(unpack_operands(optimized.payloads[15]), (1, 1))
+        self.assertEqual(Instruction.compile_program(EXAMPLE_PROGRAM1), optimized)
+        self.assertEqual(
+            Instruction.optimize(Instruction.compile_program(f"LIT {2 ** 40};\nSTORE 1;", optimize=False)).opcodes,
+            bytes((Instruction.LIT.value, Instruction.STORE.value))
+        )
+
     def test_has_payload(self) -> None:
         """test payload information"""
         has_payload = {
@@ -175,6 +218,31 @@ class MachineTest(TestCase):
         self.assertEqual(machine.stack, [])
         self.assertEqual(machine.memory, {})
 
+    def test_default_for_program(self) -> None:
+        """test default state for a program"""
+        machine = Machine.default_for_program(Instruction.compile_program(EXAMPLE_PROGRAM1), iter([]))
+        self.assertEqual(machine.counter, 1)
+        self.assertEqual(machine.stack, [])
+        self.assertEqual(machine.memory, array("q", [0] * 4))
+        machine = Machine.default_for_program(tuple(Instruction.parse_program(EXAMPLE_PROGRAM2)), iter([]))
+        self.assertEqual(machine.memory, array("q", [0] * 3))
+        self.assertEqual(
+            max_stack_depth(Instruction.compile_program(EXAMPLE_PROGRAM1, optimize=False).opcodes),
+            3
+        )
+        self.assertEqual(memory_addresses(Instruction.compile_program(EXAMPLE_PROGRAM1).unoptimized()), range(4))
+        self.assertEqual(memory_addresses(Instruction.compile_program("LIT 1;")), range(0))
+        self.assertIsNone(memory_addresses(Instruction.compile_program("READ 1;\nSTORE -1;")))
+        for program in ("LIT 1;", "STORE -1;", f"STORE {Machine.MAX_FLAT_ADDRESS + 1};"):
+            self.assertEqual(
+                Machine.default_for_program(Instruction.compile_program(program), iter([])).memory,
+                {}
+            )
+        machine = Machine.default_for_program(((Instruction.LIT, 1 << 63),), iter([]))
+        self.assertEqual(machine.memory, {})
+        with self.assertRaises(OverflowError):
+            list(machine.execute_program(((Instruction.LIT, 1 << 63),)))
+
     def test_reset(self) -> None:
         """test reset state"""
         iterator = iter(range(0))
@@ -184,6 +252,28 @@ class MachineTest(TestCase):
         self.assertEqual(machine.stack, [])
         self.assertEqual(machine.memory, {})
         self.assertIs(machine.input, iterator)
+        machine = Machine(42, [1, 2], array("q", [3, 4]), iterator)
+        machine.reset()
+        self.assertEqual(machine.stack, [])
+        self.assertEqual(machine.memory, array("q", [0, 0]))
+
+    def test_stack(self) -> None:
+        """test stack handling"""
+        machine = Machine.default(iter([]))
+        machine.reserve(1)
+        for value in range(3):
+            machine.execute_instruction((Instruction.LIT, value))
+        self.assertEqual(machine.stack, [0, 1, 2])
+        machine.execute_instruction((Instruction.ADD, 0))
+        machine.execute_instruction((Instruction.ADD, 0))
+        self.assertEqual(machine.stack, [3])
+        with self.assertRaises(IndexError):
+            machine.execute_instruction((Instruction.SUB, 0))
+        machine.execute_instruction((Instruction.STORE, 0))
+        with self.assertRaises(IndexError):
+            machine.execute_instruction((Instruction.STORE, 0))
+        self.assertEqual(machine.stack, [])
+        self.assertEqual(machine.memory, {0: 3})
 
     def test_status(self) -> None:
         """test status information"""
@@ -207,6 +297,26 @@ class MachineTest(TestCase):
             Machine(42, [1, 2], {3: 4, 5: 6}, iter(range(9))).state(range(1, 3), range(2)),
             "(42, 2 : 1, [3/4, 5/6], 1 : 2, 0 : 1)"
         )
+        self.assertEqual(
+            Machine(42, [1, 2], array("q", [3, 4]), iter(range(9))).state([], []),
+            "(42, 2 : 1, [0/3, 1/4], ε, ε)"
+        )
+
+    def test_execute_opcode(self) -> None:
+        """test execution of single opcodes"""
+        machine = Machine.default(iter([]))
+        self.assertIsNone(machine.execute_opcode(Instruction.LIT, 7))
+        self.assertIsNone(machine.execute_opcode(LIT_STORE, pack_operands(7, 1)))
+        self.assertEqual(machine.execute_opcode(Instruction.WRITE, 1), 7)
+        self.assertEqual(machine.counter, 5)
+        for opcode in (0, 19, 99, 255):
+            with self.assertRaises(ValueError):
+                machine.execute_opcode(opcode, 0)
+        self.assertEqual(machine.counter, 5)
+        machine = Machine(1, [9], array("q", [0]), iter([]))
+        with self.assertRaises(IndexError):
+            machine.execute_opcode(Instruction.STORE, 7)
+        self.assertEqual(machine.stack, [9])
 
     def test_execute(self) -> None:
         """test program execution"""
@@ -222,3 +332,162 @@ class MachineTest(TestCase):
             [1, 1, 1, 1, 0, 1, 0]
         )
         self.assertIsNone(next(machine.input, None))
+        execution = machine.execute_program(((Instruction.LIT, 1), (Instruction.ADD,)))  # type: ignore[arg-type]
+        self.assertIsNone(next(execution))
+        with self.assertRaises(ValueError):
+            next(execution)
+
+    def test_execute_compiled(self) -> None:
+        """test compiled program execution"""
+        program1 = Instruction.compile_program(EXAMPLE_PROGRAM1, optimize=False)
+        program2 = Instruction.compile_program(EXAMPLE_PROGRAM2, optimize=False)
+        machine = Machine.default_for_program(program1, iter([2, 42]))
+        self.assertEqual(
+            list(machine.execute_program(program1)),
+            [None] * 39 + [5]
+        )
+        self.assertEqual(
+            list(filter(lambda value: value is not None, machine.execute_program(program2))),
+            [1, 1, 1, 1, 0, 1, 0]
+        )
+        self.assertIsNone(next(machine.input, None))
+
+    def test_execute_optimized(self) -> None:
+        """test optimized program execution"""
+        for source, values, output in (
+            (EXAMPLE_PROGRAM1, [2], [5]),
+            (EXAMPLE_PROGRAM1, [4], [30]),
+            (EXAMPLE_PROGRAM2, [42], [1, 1, 1, 1, 0, 1, 0]),
+            ("LIT 1;\nJMP 4;\nLIT 2;\nSTORE 0;\nLOAD 0;\nLIT 3;\nADD;\nSTORE 1;\nWRITE 1;", [], [4])
+        ):
+            assert_same_execution(
+                self,
+                Machine,
+                Instruction.compile_program(source),
+                values,
+                output,
+                lambda machine, program: [value for value in machine.execute_program(program) if value is not None],
+                lambda machine, program: [
+                    value for value in machine.execute_program(program.unoptimized()) if value is not None
+                ]
+            )
+
+    def test_run(self) -> None:
+        """test running a program until it halts"""
+        program = Instruction.compile_program(EXAMPLE_PROGRAM2)
+        machine = Machine.default_for_program(program, iter([42]))
+        self.assertEqual(machine.run(program), [1, 1, 1, 1, 0, 1, 0])
+        self.assertEqual(machine.counter, len(program) + 1)
+        threaded = machine.thread_program(Instruction.compile_program("LIT 1;\nJMP 0;"))
+        self.assertEqual([instruction(index) for index, instruction in enumerate(threaded)], [1, -1])
+        self.assertEqual(machine.stack, [1])
+        self.assertEqual(machine.output, [])
+        machine = Machine.default(iter([3]))
+        self.assertEqual(machine.run(tuple(Instruction.parse_program(EXAMPLE_PROGRAM1))), [14])
+        machine.reset()
+        with self.assertRaises(StopIteration):
+            machine.run(Instruction.compile_program("LIT 1;\nSTORE 1;\nWRITE 1;\nREAD 1;"))
+        self.assertEqual(machine.counter, 4)
+        self.assertEqual(machine.output, [1])
+
+
+class JitTest(TestCase):
+    """AM0 kernel tests"""
+
+    def test_run(self) -> None:
+        """test running a compiled program"""
+        program = Instruction.compile_program(EXAMPLE_PROGRAM1, optimize=False)
+        memory = array("q", [0] * 4)
+        output = array("q", [0])
+        registers = array("q", [1, 0, 0, 0])
+        jit_run(program.opcodes, program.payloads, memory, array("q", [0] * 4), array("q", [2]), output, registers)
+        self.assertEqual(list(registers), [22, 0, 1, 1])
+        self.assertEqual(list(memory), [0, 3, 2, 5])
+        self.assertEqual(list(output), [5])
+
+    def test_interrupt(self) -> None:
+        """test stopping at instructions which can not be executed"""
+        program = Instruction.compile_program("LIT 1;\nLIT 0;\nDIV;\nREAD 0;\nSTORE 9;", optimize=False)
+        registers = array("q", [1, 0, 0, 0])
+        stack = array("q", [0] * 2)
+        jit_run(program.opcodes, program.payloads, array("q", [0]), stack, array("q"), array("q"), registers)
+        self.assertEqual(list(registers), [3, 2, 0, 0])
+        registers[0] = 4
+        jit_run(program.opcodes, program.payloads, array("q", [0]), stack, array("q"), array("q"), registers)
+        self.assertEqual(list(registers), [4, 2, 0, 0])
+        registers[0] = 5
+        jit_run(program.opcodes, program.payloads, array("q", [0]), stack, array("q"), array("q"), registers)
+        self.assertEqual(list(registers), [5, 2, 0, 0])
+
+    def test_overflow(self) -> None:
+        """test stopping at arithmetic which overflows"""
+        for left, right, operation in (
+            (9223372036854775807, 1, "ADD"),
+            (-9223372036854775808, 1, "SUB"),
+            (4611686018427387904, 4, "MUL"),
+            (-1, -9223372036854775808, "MUL"),
+            (-9223372036854775808, -1, "DIV"),
+            (-9223372036854775808, -1, "MOD")
+        ):
+            program = Instruction.compile_program(f"LIT {left};\nLIT {right};\n{operation};", optimize=False)
+            registers = array("q", [1, 0, 0, 0])
+            stack = array("q", [0] * 2)
+            jit_run(program.opcodes, program.payloads, array("q"), stack, array("q"), array("q"), registers)
+            self.assertEqual(list(registers), [3, 2, 0, 0])
+            self.assertEqual(list(stack), [left, right])
+
+    def test_execute_program_jit(self) -> None:
+        """test executing a program with the kernel and interpreter"""
+        for source, values, output in (
+            (EXAMPLE_PROGRAM1, [2], [5]),
+            (EXAMPLE_PROGRAM2, [42], [1, 1, 1, 1, 0, 1, 0]),
+            ("LIT 1;\nLIT 2;\nLIT 3;\nLIT 4;\nADD;\nADD;\nADD;\nSTORE 0;\nWRITE 0;", [], [10]),
+            ("LIT 3037000499;\nLIT -3037000499;\nMUL;\nSTORE 0;\nWRITE 0;", [], [-9223372030926249001])
+        ):
+            assert_same_execution(
+                self,
+                Machine,
+                Instruction.compile_program(source),
+                values,
+                output,
+                Machine.execute_program_jit,
+                Machine.run
+            )
+        machine = Machine.default_for_program(Instruction.compile_program("LIT 1;\nLIT 0;\nDIV;"), iter([]))
+        with self.assertRaises(ZeroDivisionError):
+            machine.execute_program_jit(Instruction.compile_program("LIT 1;\nLIT 0;\nDIV;"))
+        self.assertEqual(machine.counter, 3)
+        self.assertEqual(machine.stack, [1, 0])
+        program = Instruction.compile_program("LIT 4611686018427387904;\nLIT 4;\nMUL;\nSTORE 0;")
+        machine = Machine.default_for_program(program, iter([]))
+        with self.assertRaises(OverflowError):
+            machine.execute_program_jit(program)
+        self.assertEqual(machine.counter, 3)
+
+
+class CompileToPythonTest(TestCase):
+    """AM0 translation tests"""
+
+    def run_program(self, source: str, memory: dict[int, int], values: list[int]) -> tuple[list[int], list[int]]:
+        """translate and run a program, returning the stack and output"""
+        namespace: dict[str, Any] = {}
+        exec(compile_to_python(Instruction.compile_program(source)), namespace)
+        stack: list[int] = []
+        output: list[int] = []
+        namespace["run"](stack, memory, iter(values), output)
+        return stack, output
+
+    def test_run(self) -> None:
+        """test running a translated program"""
+        memory: dict[int, int] = {}
+        self.assertEqual(self.run_program(EXAMPLE_PROGRAM1, memory, [2]), ([], [5]))
+        self.assertEqual(memory, {1: 3, 2: 2, 3: 5})
+        self.assertEqual(self.run_program("LIT 1;\nJMP 4;\nLIT 2;\nLIT 3;\nJMP 0;\nLIT 4;", {}, []), ([1, 3], []))
+        self.assertEqual(self.run_program("", {}, []), ([], []))
+        self.assertEqual(
+            self.run_program("LIT 1;\nLIT 2;\nLT;\nJMC 6;\nLIT 3;\nLIT 2;\nLIT 1;\nLT;\nJMC 11;\nLIT 4;", {}, []),
+            ([3], [])
+        )
+        self.assertEqual(self.run_program("LIT 0;\nJMP 5;\nLIT 1;\nEQ;\nJMC 7;\nLIT 3;\nLIT 4;", {}, []), ([4], []))
+        with self.assertRaises(IndexError):
+            self.run_program("ADD;", {}, [])
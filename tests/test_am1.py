@@ -2,8 +2,11 @@
 
 """AM1 Tests"""
 
+from array import array
+from typing import Any
 from unittest import TestCase
-from AMN.am1 import Instruction, Machine, MemoryContext
+from AMN.am1 import Instruction, Machine, MemoryContext, jit_run, compile_to_python, max_runtime_depth
+from . import assert_same_execution
 
 
 # do not remove trailing whitespace!
@@ -94,6 +97,10 @@ STOREI 2;
 WRITEI 2;
 """
 
+PROGRAM1 = tuple(Instruction.parse_program(EXAMPLE_PROGRAM1))
+
+PROGRAM2 = tuple(Instruction.parse_program(EXAMPLE_PROGRAM2))
+
 
 class InstructionTest(TestCase):
     """AM1 instruction tests"""
@@ -120,8 +127,20 @@ class InstructionTest(TestCase):
             Instruction.parse("LOAD lokal,-3")
         with self.assertRaises(KeyError):
             Instruction.parse("LOAD(xxx,-3)")
+        self.assertEqual(
+            Instruction.parse("LOAD(global, 3)"),
+            (Instruction.LOAD, MemoryContext.GLOBAL, 3)
+        )
+        self.assertEqual(
+            Instruction.parse("LOADI(-2)"),
+            (Instruction.LOADI, MemoryContext.LOKAL, -2)
+        )
         with self.assertRaises(ValueError):
             Instruction.parse("LOAD(lokal,xxx)")
+        with self.assertRaises(KeyError):
+            Instruction.parse("LOAD(lokal,-3")
+        with self.assertRaises(KeyError):
+            Instruction.parse("load 1")
 
     def test_parse_program(self) -> None:
         """test program parsing"""
@@ -170,6 +189,33 @@ class InstructionTest(TestCase):
         with self.assertRaises(ValueError):
             list(Instruction.parse_program("LOAD 1;\n ADD;\nJMP 3;"))
 
+    def test_compile_program(self) -> None:
+        """test program compilation"""
+        program = Instruction.compile_program(EXAMPLE_PROGRAM1, optimize=False)
+        self.assertEqual(
+            program,
+            Instruction.compile(PROGRAM1)
+        )
+        self.assertEqual(
+            list(zip(program.opcodes, program.payloads)),
+            list(map(Instruction.encode, PROGRAM1))
+        )
+        self.assertNotEqual(program.opcodes[4], program.opcodes[25])
+        self.assertEqual(len(Instruction.compile_program("")), 0)
+        with self.assertRaises(ValueError):
+            Instruction.compile_program("LOAD(global, 0);")
+        opcodes = bytearray()
+        payloads = array("q")
+        Instruction.parse_into("LOAD(global, 3)", opcodes, payloads)
+        Instruction.parse_into("JMP 2", opcodes, payloads)
+        self.assertEqual(
+            list(zip(opcodes, payloads)),
+            [
+                Instruction.encode((Instruction.LOAD, MemoryContext.GLOBAL, 3)),
+                Instruction.encode((Instruction.JMP, MemoryContext.LOKAL, 2))
+            ]
+        )
+
     def test_has_payload(self) -> None:
         """test payload information"""
         has_payload = {
@@ -239,6 +285,16 @@ class MachineTest(TestCase):
         self.assertEqual(machine.runtime_stack, [])
         self.assertEqual(machine.reference_pointer, 0)
 
+    def test_default_for_program(self) -> None:
+        """test default state for a program"""
+        program = Instruction.compile_program(EXAMPLE_PROGRAM1)
+        machine = Machine.default_for_program(program, iter([5]))
+        self.assertEqual(machine.counter, 1)
+        self.assertEqual(machine.stack, [])
+        self.assertEqual(machine.runtime_stack, [])
+        self.assertEqual(max_runtime_depth(program), 12)
+        self.assertEqual(machine.run(program), [10])
+
     def test_reset(self) -> None:
         """test reset state"""
         iterator = iter(range(0))
@@ -250,6 +306,32 @@ class MachineTest(TestCase):
         self.assertEqual(machine.reference_pointer, 0)
         self.assertIs(machine.input, iterator)
 
+    def test_init(self) -> None:
+        """test allocating variables"""
+        machine = Machine(1, [], [4, 6], 0, iter([]))
+        machine.execute_instruction((Instruction.INIT, MemoryContext.LOKAL, 3))
+        self.assertEqual(machine.runtime_stack, [4, 6, 0, 0, 0])
+        machine.execute_instruction((Instruction.INIT, MemoryContext.LOKAL, 0))
+        self.assertEqual(machine.runtime_stack, [4, 6, 0, 0, 0])
+
+    def test_call(self) -> None:
+        """test calling and returning"""
+        machine = Machine(1, [], [7], 0, iter([]))
+        machine.execute_instruction((Instruction.CALL, MemoryContext.LOKAL, 5))
+        machine.execute_instruction((Instruction.INIT, MemoryContext.LOKAL, 2))
+        machine.execute_instruction((Instruction.LIT, MemoryContext.LOKAL, 9))
+        machine.execute_instruction((Instruction.STORE, MemoryContext.LOKAL, 1))
+        self.assertEqual(machine.runtime_stack, [7, 2, 0, 9, 0])
+        self.assertEqual(machine.reference_pointer, 3)
+        with self.assertRaises(IndexError):
+            machine.execute_instruction((Instruction.LOAD, MemoryContext.LOKAL, 3))
+        machine.execute_instruction((Instruction.RET, MemoryContext.LOKAL, 1))
+        self.assertEqual(machine.counter, 2)
+        self.assertEqual(machine.reference_pointer, 0)
+        self.assertEqual(machine.runtime_stack, [])
+        machine.execute_instruction((Instruction.INIT, MemoryContext.LOKAL, 3))
+        self.assertEqual(machine.runtime_stack, [0, 0, 0])
+
     def test_status(self) -> None:
         """test status information"""
         machines = [
@@ -276,8 +358,22 @@ class MachineTest(TestCase):
 
     def test_execute(self) -> None:
         """test program execution"""
-        program1 = tuple(Instruction.parse_program(EXAMPLE_PROGRAM1))
-        program2 = tuple(Instruction.parse_program(EXAMPLE_PROGRAM2))
+        machine = Machine.default(iter([1, 42]))
+        self.assertEqual(
+            list(machine.execute_program(PROGRAM1)),
+            [None] * 35 + [2, None, None]
+        )
+        machine.reset()
+        self.assertEqual(
+            list(filter(lambda value: value is not None, machine.execute_program(PROGRAM2))),
+            [1, 1, 1, 1, 0, 1, 0]
+        )
+        self.assertIsNone(next(machine.input, None))
+
+    def test_execute_compiled(self) -> None:
+        """test compiled program execution"""
+        program1 = Instruction.compile_program(EXAMPLE_PROGRAM1, optimize=False)
+        program2 = Instruction.compile_program(EXAMPLE_PROGRAM2, optimize=False)
         machine = Machine.default(iter([1, 42]))
         self.assertEqual(
             list(machine.execute_program(program1)),
@@ -289,6 +385,26 @@ class MachineTest(TestCase):
             [1, 1, 1, 1, 0, 1, 0]
         )
         self.assertIsNone(next(machine.input, None))
+        machine = Machine.default(iter([42]))
+        self.assertEqual(machine.run(program2), [1, 1, 1, 1, 0, 1, 0])
+
+    def test_execute_optimized(self) -> None:
+        """test optimized program execution"""
+        for source, values, output in (
+            (EXAMPLE_PROGRAM1, [5], [10]),
+            (EXAMPLE_PROGRAM2, [42], [1, 1, 1, 1, 0, 1, 0]),
+            ("INIT 1;\nLIT 3;\nPUSH;\nLOADA(lokal, 1);\nPUSH;\nLOAD(global, 2);\nPUSH;\nWRITE(global, 4);", [], [3]),
+            ("LIT 2;\nLIT 3;\nADD;\nLIT -7;\nADD;\nPUSH;\nWRITE(global, 1);", [], [-2])
+        ):
+            assert_same_execution(
+                self,
+                Machine,
+                Instruction.compile_program(source),
+                values,
+                output,
+                Machine.run,
+                lambda machine, program: machine.run(program.unoptimized())
+            )
 
     def test_frames(self) -> None:
         """test frame detection"""
@@ -301,6 +417,7 @@ class MachineTest(TestCase):
                 [4, 6]
             ]
         )
+        self.assertEqual(list(machine.frame_ranges()), [range(6, 9), range(2, 6), range(2)])
         machine = Machine(42, [1, 2], [2, 0, 3, 4, 42, 2, 99], 6, iter([]))
         self.assertEqual(
             list(machine.frames()),
@@ -313,3 +430,111 @@ class MachineTest(TestCase):
             list(Machine.default(iter([])).frames()),
             []
         )
+
+
+class JitTest(TestCase):
+    """AM1 kernel tests"""
+
+    def test_run(self) -> None:
+        """test running a compiled program"""
+        program = Instruction.compile_program(EXAMPLE_PROGRAM1, optimize=False)
+        runtime_stack = array("q", [0] * 32)
+        output = array("q", [0])
+        registers = array("q", [1, 0, 0, 0, 0, 0])
+        jit_run(program.opcodes, program.payloads, array("q", [0] * 4), runtime_stack, array("q", [5]), output, registers)
+        self.assertEqual(list(registers), [0, 0, 2, 0, 1, 1])
+        self.assertEqual(list(runtime_stack[:2]), [5, 10])
+        self.assertEqual(list(output), [10])
+
+    def test_interrupt(self) -> None:
+        """test stopping at instructions which can not be executed"""
+        program = Instruction.compile_program("LIT 1;\nLIT 0;\nDIV;\nREAD(global, 1);\nRET 0;", optimize=False)
+        registers = array("q", [1, 0, 0, 0, 0, 0])
+        stack = array("q", [0] * 2)
+        for start, counter in ((1, 3), (4, 4), (5, 5)):
+            registers[0] = start
+            jit_run(program.opcodes, program.payloads, stack, array("q"), array("q"), array("q"), registers)
+            self.assertEqual(list(registers), [counter, 2, 0, 0, 0, 0])
+
+    def test_overflow(self) -> None:
+        """test stopping at arithmetic which overflows"""
+        for left, right, operation in (
+            (9223372036854775807, 1, "ADD"),
+            (-9223372036854775808, 1, "SUB"),
+            (4611686018427387904, 4, "MUL"),
+            (-1, -9223372036854775808, "MUL"),
+            (-9223372036854775808, -1, "DIV"),
+            (-9223372036854775808, -1, "MOD")
+        ):
+            program = Instruction.compile_program(f"LIT {left};\nLIT {right};\n{operation};", optimize=False)
+            registers = array("q", [1, 0, 0, 0, 0, 0])
+            stack = array("q", [0] * 2)
+            jit_run(program.opcodes, program.payloads, stack, array("q"), array("q"), array("q"), registers)
+            self.assertEqual(list(registers), [3, 2, 0, 0, 0, 0])
+            self.assertEqual(list(stack), [left, right])
+
+    def test_execute_program_jit(self) -> None:
+        """test executing a program with the kernel and interpreter"""
+        for source, values, output in (
+            (EXAMPLE_PROGRAM1, [5], [10]),
+            (EXAMPLE_PROGRAM1, [30], [60]),
+            (EXAMPLE_PROGRAM2, [42], [1, 1, 1, 1, 0, 1, 0]),
+            ("LIT 3037000499;\nLIT -3037000499;\nMUL;\nPUSH;\nWRITE(global, 1);", [], [-9223372030926249001])
+        ):
+            assert_same_execution(
+                self,
+                Machine,
+                Instruction.compile_program(source),
+                values,
+                output,
+                Machine.execute_program_jit,
+                Machine.run
+            )
+        machine = Machine.default(iter([]))
+        with self.assertRaises(ZeroDivisionError):
+            machine.execute_program_jit(Instruction.compile_program("LIT 1;\nLIT 0;\nDIV;"))
+        self.assertEqual(machine.counter, 3)
+        self.assertEqual(machine.stack, [1, 0])
+        program = Instruction.compile_program("LIT 4611686018427387904;\nLIT 4;\nMUL;\nPUSH;\nWRITE(global, 1);")
+        machine = Machine.default_for_program(program, iter([]))
+        with self.assertRaises(OverflowError):
+            machine.execute_program_jit(program)
+        self.assertEqual(machine.counter, 3)
+        self.assertEqual(machine.stack, [4611686018427387904, 4])
+
+    def test_invalid_return(self) -> None:
+        """test returning with a corrupted call frame or negative parameters"""
+        for source, error in (
+            ("CALL 3;\nRET 0;\nLIT 100000000;\nSTORE(lokal, 0);\nRET 0;", LookupError),
+            ("CALL 6;\nLIT 7;\nSTORE(global, 50000);\nWRITE(global, 50000);\nJMP 0;\nRET -100000;", IndexError)
+        ):
+            program = Instruction.compile_program(source)
+            for execute in (Machine.execute_program_jit, Machine.run):
+                with self.assertRaises(error):
+                    execute(Machine.default(iter([])), program)
+
+
+class CompileToPythonTest(TestCase):
+    """AM1 translation tests"""
+
+    def test_run(self) -> None:
+        """test running a translated program"""
+        for source, values in ((EXAMPLE_PROGRAM1, [5]), (EXAMPLE_PROGRAM2, [42])):
+            program = Instruction.compile_program(source, optimize=False)
+            self.assertIs(compile_to_python(program), compile_to_python(program))
+            namespace: dict[str, Any] = {}
+            exec(compile_to_python(program), namespace)
+            stack: list[int] = []
+            runtime_stack: list[int] = []
+            output: list[int] = []
+            reference_pointer = namespace["run"](stack, runtime_stack, 0, iter(values), output)
+            machine = Machine.default(iter(values))
+            self.assertEqual(output, machine.run(program))
+            self.assertEqual(stack, machine.stack)
+            self.assertEqual(runtime_stack, machine.runtime_stack)
+            self.assertEqual(reference_pointer, machine.reference_pointer)
+        namespace = {}
+        exec(compile_to_python(Instruction.compile_program("LOAD(lokal, 0);")), namespace)
+        with self.assertRaises(ValueError):
+            namespace["run"]([], [], 0, iter([]), [])
+
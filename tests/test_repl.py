@@ -2,29 +2,58 @@
 
 """REPL tests"""
 
-from collections import deque
-from collections.abc import Iterator
+from collections.abc import Iterator, Iterable
 from io import StringIO
 from unittest import TestCase
 from AMN.am0 import Instruction, Machine
 from AMN.repl import REPL
 
 
+class ListIO:
+    """minimal text output collecting the written strings in a list"""
+
+    __slots__ = ("parts",)
+
+    parts: list[str]
+
+    def __init__(self) -> None:
+        self.parts = []
+
+    def write(self, value: str) -> int:
+        """append a string"""
+        self.parts.append(value)
+        return len(value)
+
+    def writelines(self, lines: Iterable[str]) -> None:
+        """append multiple strings"""
+        self.parts.extend(lines)
+
+    def flush(self) -> None:
+        """do nothing"""
+
+    def getvalue(self) -> str:
+        """return everything written so far"""
+        return "".join(self.parts)
+
+
 class ReplTest(TestCase):
     """REPL tests"""
 
     repl: REPL[tuple[Instruction, int]]
 
-    input: deque[int]
+    input: list[int]
+
+    input_index: int
 
     stdin: StringIO
 
-    stdout: StringIO
+    stdout: ListIO
 
     def setUp(self) -> None:
-        self.input = deque()
+        self.input = []
+        self.input_index = 0
         self.stdin = StringIO()
-        self.stdout = StringIO()
+        self.stdout = ListIO()
         self.repl = REPL(
             Instruction,
             Machine.default(self.lazy_input()),
@@ -35,11 +64,9 @@ class ReplTest(TestCase):
 
     def lazy_input(self) -> Iterator[int]:
         """Lazy consume the input"""
-        while True:
-            try:
-                yield self.input.pop()
-            except IndexError:
-                break
+        while self.input_index < len(self.input):
+            yield self.input[self.input_index]
+            self.input_index += 1
 
     def set_stdin(self, value: str) -> None:
         """Set the current stdin"""
@@ -50,8 +77,7 @@ class ReplTest(TestCase):
 
     def reset_stdout(self) -> None:
         """Reset stdout"""
-        self.stdout.seek(0)
-        self.stdout.truncate(0)
+        self.stdout.parts.clear()
 
     def test_emptyline(self) -> None:
         """Test the empty line"""
@@ -70,12 +96,12 @@ class ReplTest(TestCase):
             self.stdout.getvalue(),
             (
                 f"{self.repl.prompt}Error while parsing: KeyError('sadasdasd')\n"
-                f"{self.repl.prompt}Error while executing: IndexError('list index out of range')\n"
+                f"{self.repl.prompt}Error while executing: IndexError('stack underflow')\n"
                 f"{self.repl.prompt}Exiting REPL...\n"
             )
         )
         self.set_stdin("exec READ 1\nexec WRITE 1\n")
-        self.input.appendleft(3)
+        self.input.append(3)
         self.reset_stdout()
         self.repl.cmdloop()
         self.assertEqual(
@@ -86,6 +112,17 @@ class ReplTest(TestCase):
             )
         )
         self.assertEqual(self.repl.machine.counter, 3)
+        self.set_stdin("exec LIT 1\nexec LIT 0\nexec DIV\n")
+        self.reset_stdout()
+        self.repl.cmdloop()
+        self.assertEqual(
+            self.stdout.getvalue(),
+            (
+                f"{self.repl.prompt * 3}Error while executing: ZeroDivisionError('integer division or modulo by zero')\n"
+                f"{self.repl.prompt}Exiting REPL...\n"
+            )
+        )
+        self.assertEqual(self.repl.machine.state([], []), "(5, 0 : 1, [1/3], ε, ε)")
 
     def test_reset(self) -> None:
         """Test the reset command"""
@@ -118,3 +155,31 @@ class ReplTest(TestCase):
                 f"{self.repl.prompt}Exiting REPL...\n"
             )
         )
+
+    def test_run(self) -> None:
+        """Test the run command"""
+        self.set_stdin("run\nREAD 1;\nLOAD 1;\nLIT 1;\nADD;\nSTORE 1;\nWRITE 1;\n.\nrun\nADD;\n.\n")
+        self.input.append(3)
+        self.repl.cmdloop()
+        self.assertEqual(
+            self.stdout.getvalue(),
+            (
+                f"{self.repl.prompt}{self.repl.continuation_prompt * 7}Output: 4\n"
+                f"{self.repl.prompt}{self.repl.continuation_prompt * 2}"
+                "Error while executing: IndexError('stack underflow')\n"
+                f"{self.repl.prompt}Exiting REPL...\n"
+            )
+        )
+        self.set_stdin("run\nLIT 1\n.\nLIT 2\nXXX\n")
+        self.reset_stdout()
+        self.repl.cmdloop()
+        self.assertEqual(
+            self.stdout.getvalue(),
+            (
+                f"{self.repl.prompt}{self.repl.continuation_prompt * 2}"
+                "Error while parsing: ValueError('missing semicolon on line 1')\n"
+                f"{self.repl.prompt * 2}*** Unknown command: XXX\n"
+                f"{self.repl.prompt}Exiting REPL...\n"
+            )
+        )
+        self.assertEqual(self.repl.machine.counter, 2)